@@ -1,17 +1,30 @@
-from flask import Flask, redirect, render_template, request, session, flash, g
+from flask import Flask, abort, redirect, render_template, request, session, flash, g, jsonify, url_for
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+import click
 
-from models import db, connect_db, User, Playlist, PlaylistSong, Song
-from access import CLIENT_ID, CLIENT_SECRET
+from models import db, connect_db, User, Playlist, PlaylistSong, Song, SearchResult
 from forms import SignupForm, LoginForm, SongForm, PlaylistForm
-from utilities import get_id, get_genres,  get_keys
-from client import SpotifyClient
-import requests
+from utilities import search, get_genres
+from client import SpotifyClient, recommendation_cache, payload_key
+from features import get_audio_features
+from tokens import token_manager, TokenError
+from explain import check_query_plans
+from setorder import cached_set_order
+from querycount import init_query_stats
+from metrics import init_metrics, metrics_authorized, render_metrics, seed_phase
+from pools import engine_options
+from assets import init_assets
+from sweeper import sweep_orphan_songs, sweep_search_results, run_sweeps, start_sweeper, SWEEP_INTERVAL, SWEEP_GRACE_PERIOD, SWEEP_BATCH_SIZE, SEARCH_RESULT_TTL
 import os
 import re
 
 CURR_USER_KEY = "curr_user"
+LOST_AND_FOUND_PAGE_SIZE = int(os.environ.get('LOST_AND_FOUND_PAGE_SIZE', 50))
+LOST_AND_FOUND_MAX_PAGE_SIZE = 200
+# track rows rendered per page of search results and playlists; the rest are
+# fetched as the user scrolls
+TRACK_PAGE_SIZE = int(os.environ.get('TRACK_PAGE_SIZE', 25))
 
 app = Flask(__name__)
 
@@ -21,11 +34,20 @@ if uri.startswith("postgres://"):
     uri = uri.replace("postgres://", "postgresql://", 1)
 app.config["SQLALCHEMY_DATABASE_URI"] = uri
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
+# pool sizes are derived from the gunicorn worker settings, see gunicorn.conf.py
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
+# logs every statement; per-request query counts are logged by querycount instead
+app.config['SQLALCHEMY_ECHO'] = os.environ.get('SQLALCHEMY_ECHO') == '1'
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'hellosecret1')
 
 connect_db(app)
+init_query_stats(app)
+init_metrics(app)
+init_assets(app)
+
+if SWEEP_INTERVAL:
+    start_sweeper(app)
 
 
 
@@ -41,6 +63,52 @@ def add_user_to_g():
     else:
         g.user = None
 
+########################### - CLI COMMANDS - ###################################
+
+
+@app.cli.command('sweep-songs')
+@click.option('--grace-period', default=SWEEP_GRACE_PERIOD, help='Seconds an unused song is kept after it was last seen')
+@click.option('--batch-size', default=SWEEP_BATCH_SIZE, help='Songs deleted per transaction')
+@click.option('--result-ttl', default=SEARCH_RESULT_TTL, help='Seconds a stored search result is kept')
+@click.option('--every', default=0, help='Keep running and sweep again every N seconds')
+def sweep_songs(grace_period, batch_size, result_ttl, every):
+    """Delete old search results and songs that aren't on any playlist"""
+
+    click.echo(f"Deleted {sweep_search_results(ttl=result_ttl)} search results")
+    stats = sweep_orphan_songs(grace_period=grace_period, batch_size=batch_size)
+    click.echo(
+        f"Deleted {stats['deleted']} songs in {stats['batches']} batches ({stats['seconds']}s)")
+    if every:
+        run_sweeps(app, every, grace_period=grace_period, batch_size=batch_size,
+                   result_ttl=result_ttl)
+
+
+@app.cli.command('explain-check')
+def explain_check():
+    """Check that the main routes' queries use their indexes"""
+
+    results = check_query_plans()
+    for description, passed, plan in results:
+        click.echo(f"{'ok  ' if passed else 'FAIL'} {description}")
+        if not passed:
+            click.echo('     ' + plan.replace('\n', '\n     '))
+
+    if not all(passed for description, passed, plan in results):
+        raise SystemExit(1)
+
+
+@app.route('/metrics')
+def show_metrics():
+    """Prometheus metrics, aggregated over every gunicorn worker. Only shown
+    to scrapers that send METRICS_TOKEN"""
+
+    if not metrics_authorized(request.headers.get('Authorization')):
+        abort(401)
+
+    body, content_type = render_metrics()
+    return body, 200, {'Content-Type': content_type}
+
+
 ######################## - USER ROUTES and FUNCTIONS - #########################
 
 
@@ -55,12 +123,9 @@ def do_logout():
 
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
-    if 'track_id_list' in session:
-        del session['track_id_list']
-    # On log out, delete the 'lost n found', which consists of songs users didnt add to a playlist
-    save_songs = [s.id for s in Song.query.filter(Song.playlists).all()]
-    Song.query.filter(Song.id.notin_(save_songs)).delete()
-    db.session.commit()
+    if 'search_id' in session:
+        del session['search_id']
+    # songs nobody added to a playlist are cleaned out of 'lost n found' by the sweeper
 
 
 @app.route('/')
@@ -94,7 +159,7 @@ def signup():
 
         do_login(user)
 
-        return redirect('/auth')
+        return redirect('/')
 
     else:
         return render_template('signup.html', form=form)
@@ -111,9 +176,11 @@ def login():
                                  form.password.data)
 
         if user:
+            # saves the password if it was rehashed at a new cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
-            return redirect("/auth")
+            return redirect("/")
 
         flash("Invalid credentials.", 'danger')
 
@@ -129,6 +196,7 @@ def demo():
     user = User.authenticate(demo_username, demo_password)
 
     if user:
+        db.session.commit()
         do_login(user)
         flash(f"Hello, {user.username}!", "success")
         return redirect("/")
@@ -149,32 +217,34 @@ def logout():
 
 @app.route('/auth')
 def get_token():
-    """Authenticates the app with Spotify's API"""
+    """Kept for old links. The app-wide Spotify token is fetched and refreshed
+    by token_manager when it's needed, so there is nothing to do here"""
 
-    if 'token' in session:
-        session.pop('token')
+    return redirect('/')
 
-    resp = requests.post('https://accounts.spotify.com/api/token',
-                         {'grant_type': 'client_credentials',
-                          'client_id': CLIENT_ID,
-                          'client_secret': CLIENT_SECRET}).json()
-    token = resp['access_token']
-    session['token'] = token
 
-    return redirect('/')
+@app.errorhandler(TokenError)
+def spotify_unavailable(e=None):
+    """Shows an error page when Spotify can't be reached or won't issue a token"""
+
+    return render_template('error.html', message="We couldn't reach Spotify. Please try again in a moment."), 503
+
 
 ################## -SEARCH ROUTES- ###################################
 
 
 @app.route('/search')
 def artist_or_track_search():
-    """Sends request to API with track or artist query and returns a list of
-    tuples with with Spotify ID and corresponding track/artist name"""
+    """Sends request to API with track or artist query and returns the
+    matching Spotify IDs with their track/artist names"""
+
+    # the pooled connection isn't needed while waiting on Spotify
+    db.session.close()
 
     try:
-        name = request.args.get('q')
+        name = request.args.get('q', '')
         type = request.args.get('type')
-        resp = get_id(name, type)
+        resp = search(name, type)
         return resp
 
     except KeyError:
@@ -190,32 +260,35 @@ def get_music():
 
     form = SongForm()
     user = User.query.get_or_404(session[CURR_USER_KEY])
+    # end the transaction so the pooled connection goes back to the pool
+    # rather than waiting on Spotify with the request; the loaded user stays
+    # readable and the songs and results are saved in transactions of their own
+    db.session.close()
 
     # populate genre select field with choice from Spotify
     try:
-        form.genre.choices = get_genres()
-    # if access token expires, a key error is raised. In that case, request new token and display form
+        with seed_phase('genres'):
+            form.genre.choices = get_genres()
+    # if the access token is rejected, a key error is raised. In that case the
+    # token is discarded, so the next attempt fetches a new one
     except KeyError:
-        return redirect('/auth')
+        token_manager.invalidate()
+        return spotify_unavailable()
 
     if form.validate_on_submit():
         try:
-            headers = {'Authorization': 'Bearer ' + session['token']}
             payload = {}
 
-            # gets artist ids for search, if any
+            # gets artist ids for search, if any. More than 5 seeds in total
+            # are split over several concurrent requests by SpotifyClient
             if request.form.get('artist'):
-                artist_list = ''
-                for artist in request.form.getlist('artist'):
-                    artist_list += f"{artist},"
-                payload['seed_artists'] = artist_list
+                payload['seed_artists'] = ','.join(
+                    request.form.getlist('artist'))
 
             # gets track ids for search, if any
             if request.form.get('track'):
-                track_list = ''
-                for track in request.form.getlist('track'):
-                    track_list += f"{track},"
-                payload['seed_tracks'] = track_list
+                payload['seed_tracks'] = ','.join(
+                    request.form.getlist('track'))
 
             # get genres for search if selected
             if form.genre.data:
@@ -264,41 +337,42 @@ def get_music():
             if form.mode.data:
                 payload['target_mode'] = int(form.mode.data)
 
-            # call API for song recommendations
-            resp = SpotifyClient(
-                payload=payload, headers=headers).get_recommendations()
-
-            # following code is to retrieve tempo data for each song, which isn't provided in previous response
-            track_ids = ''
-            for track in resp['tracks']:
-                track_ids += f"{track['id']},"
-
-            track_id_payload = {'ids': track_ids}
-
-            # call API for bpms of each track retrieved from previous API call
-            bpm_resp = SpotifyClient(
-                payload=track_id_payload, headers=headers).get_bpms()
-            bpm_dict = {
-                track['id']: [round(track['tempo']), track['key']] for track in bpm_resp['audio_features']}
-
-            # save track ids, tempos, and keys to session for use in results view
-            session['track_id_list'] = track_id_payload['ids']
-            session['bpm_dict'] = bpm_dict
-            keys = get_keys()[1:]
-            # add songs with their bpm/key to database
-            for song in resp['tracks']:
-                try:
-                    db.session.add(Song(song_name=song['name'],
-                                        song_seed=song['id'],
-                                        artist_name=song['artists'][0]['name'],
-                                        artist_seed=song['artists'][0]['id'],
-                                        bpm=bpm_dict[song['id']][0],
-                                        key=keys[bpm_dict[song['id']][1]][1]))
-                    db.session.commit()
-                except IntegrityError:
-                    db.session.rollback()
-
-            return redirect('/results')
+            # identical searches reuse the last results unless a refresh was asked for
+            cache_key = payload_key(payload)
+            track_ids = None if request.form.get('refresh') else recommendation_cache.get(cache_key)
+
+            if track_ids is None:
+                # call API for song recommendations
+                with seed_phase('recommendations'):
+                    resp = SpotifyClient(payload=payload).get_recommendations()
+
+                track_ids = [track['id'] for track in resp['tracks']]
+
+                # look up bpms of each track retrieved from previous API call, only
+                # asking Spotify for tracks we haven't seen before
+                with seed_phase('audio_features'):
+                    bpm_dict = get_audio_features(track_ids)
+
+                # add songs with their bpm/key to database in one statement
+                with seed_phase('ingest'):
+                    Song.bulk_upsert([{'song_name': song['name'],
+                                       'song_seed': song['id'],
+                                       'artist_name': song['artists'][0]['name'],
+                                       'artist_seed': song['artists'][0]['id'],
+                                       'bpm': bpm_dict[song['id']][0],
+                                       'key': bpm_dict[song['id']][1],
+                                       'mode': bpm_dict[song['id']][2]}
+                                      for song in resp['tracks']])
+                recommendation_cache.set(cache_key, track_ids)
+            else:
+                # bulk_upsert didn't run, the songs are still in use
+                Song.touch(track_ids)
+
+            # keep the results server side, the session only holds their id
+            search_id = SearchResult.store(track_ids, user_id=user.id)
+            session['search_id'] = search_id
+
+            return redirect(f'/results/{search_id}')
 
         except KeyError:
             flash('Please enter an artist, song, or genre', 'danger')
@@ -308,23 +382,52 @@ def get_music():
 
 
 @app.route('/results')
-def show_results():
-    """Displays results of music search form submission"""
+def show_latest_results():
+    """Redirects to the results of the user's latest music search"""
+
+    if not g.user or 'search_id' not in session:
+        return redirect('/')
+    return redirect(f"/results/{session['search_id']}")
+
+
+@app.route('/results/<search_id>')
+def show_results(search_id):
+    """Displays results of a music search form submission"""
 
     if not g.user:
         return redirect('/')
-    if 'track_id_list' not in session:
+
+    result = SearchResult.query.get(search_id)
+    if result is None:
+        flash('Those search results have expired', 'info')
         return redirect('/')
 
-    track_id_list = [id for id in session.get(
-        'track_id_list').split(',') if id]
-    tracks = Song.query.filter(Song.song_seed.in_(track_id_list)).all()
+    tracks, next_rows = result_rows(result, 0)
     if len(tracks) == 0:
         return redirect('/')
     user = g.user
     playlists = Playlist.query.filter(Playlist.user_id == user.id).all()
 
-    return render_template('results.html', tracks=tracks, playlists=playlists)
+    return render_template('results.html', songs=tracks, playlists=playlists, next_rows=next_rows)
+
+
+@app.route('/results/<search_id>/rows')
+def show_result_rows(search_id):
+    """Returns the next page of a search's track rows as an HTML fragment"""
+
+    if not g.user:
+        abort(401)
+
+    result = SearchResult.query.get_or_404(search_id)
+    tracks, next_rows = result_rows(result, max(request.args.get('offset', 0, type=int), 0))
+    return render_template('track-rows.html', songs=tracks, next_rows=next_rows)
+
+
+def result_rows(result, offset):
+    tracks, next_offset = result.page(offset, TRACK_PAGE_SIZE)
+    next_rows = None if next_offset is None else url_for(
+        'show_result_rows', search_id=result.id, offset=next_offset)
+    return tracks, next_rows
 
 ################### - PLAYLIST ROUTES - ##############################
 
@@ -339,15 +442,7 @@ def add_track_to_playlist():
         flash('You must select songs to add to playlist', 'info')
         return redirect('/results')
 
-    curr_on_playlist = [str(s.id) for s in playlist.songs]
-    songs_to_add = [s for s in songs if s not in curr_on_playlist]
-
-    for song in songs_to_add:
-        try:
-            db.session.add(PlaylistSong(playlist_id=playlist.id, song_id=song))
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
+    PlaylistSong.bulk_add(playlist.id, [int(s) for s in songs if s.isdigit()])
 
     return redirect(f'/playlists/{playlist.id}')
 
@@ -360,9 +455,7 @@ def show_playlists():
         return redirect('/')
 
     user = g.user
-    playlists = Playlist.query.filter(Playlist.user_id == user.id).all()
-    # import pdb
-    # pdb.set_trace()
+    playlists = Playlist.with_song_counts(user.id)
     return render_template('playlists.html', user=user, playlists=playlists)
 
 
@@ -415,23 +508,57 @@ def show_playlist(playlist_id, sort):
         return redirect('/')
 
     playlist = Playlist.query.get_or_404(playlist_id)
-    songlist = playlist.songs
 
     if playlist.user_id != g.user.id:
         flash("You don't have access to that playlist", 'danger')
         return redirect('/')
 
-    if sort == 'bpm':
-        songs = [song.id for song in playlist.songs]
-        songlist = Song.query.filter(
-            Song.id.in_(songs)).order_by(Song.bpm.asc())
+    songlist, next_rows = playlist_rows(playlist, sort, 0)
+    return render_template('show-playlist.html', songs=songlist, playlist=playlist, sort=sort,
+                           next_rows=next_rows)
+
+
+@app.route('/playlists/<int:playlist_id>/rows')
+def show_playlist_rows(playlist_id):
+    """Returns the next page of a playlist's track rows as an HTML fragment"""
+
+    if not g.user:
+        abort(401)
+
+    playlist = Playlist.query.get_or_404(playlist_id)
+    if playlist.user_id != g.user.id:
+        abort(403)
 
-    if sort == 'key':
-        songs = [song.id for song in playlist.songs]
-        songlist = Song.query.filter(
-            Song.id.in_(songs)).order_by(Song.key.asc())
+    songlist, next_rows = playlist_rows(playlist, request.args.get('sort') or None,
+                                        max(request.args.get('offset', 0, type=int), 0))
+    return render_template('track-rows.html', songs=songlist, playlist=playlist, next_rows=next_rows)
 
-    return render_template('show-playlist.html', songlist=songlist, playlist=playlist, sort=sort)
+
+def playlist_rows(playlist, sort, offset):
+    """Returns a page of a playlist's songs in `sort` order and the URL of
+    the next page's rows (None on the last page)"""
+
+    limit = TRACK_PAGE_SIZE
+    # orders the playlist into a DJ set with smooth tempo and key transitions
+    if sort == 'mix':
+        songlist = cached_set_order(playlist.id, playlist.songs)[offset:offset + limit + 1]
+
+    else:
+        query = Song.query.join(PlaylistSong).filter(PlaylistSong.playlist_id == playlist.id)
+        if sort == 'bpm':
+            query = query.order_by(Song.bpm.asc(), Song.id)
+        # key order follows the Camelot wheel, so neighbouring keys mix together
+        elif sort == 'key':
+            query = query.order_by(Song.camelot.asc(), Song.bpm.asc(), Song.id)
+        else:
+            query = query.order_by(PlaylistSong.id)
+        songlist = query.offset(offset).limit(limit + 1).all()
+
+    next_rows = None
+    if len(songlist) > limit:
+        next_rows = url_for('show_playlist_rows', playlist_id=playlist.id,
+                            sort=sort, offset=offset + limit)
+    return songlist[:limit], next_rows
 
 
 @app.route('/delete/<int:playlist_id>/<int:song_id>', methods=['GET', 'POST'])
@@ -461,17 +588,84 @@ def show_lost_and_found(sort):
     if not g.user:
         return redirect('/')
     user = g.user
-    songs = Song.query.order_by(Song.id.desc()).all()
-    
-    if sort == 'bpm':
-        songs = Song.query.order_by(Song.bpm.asc()).all()
 
-    if sort == 'key':
-        songs = Song.query.order_by(Song.key.asc()).all()
+    after = decode_cursor(request.args.get('after'))
+    songs, next_rows = lost_and_found_rows(sort, after)
 
-    if len(songs) == 0:
+    if len(songs) == 0 and not after:
         flash("Nothing in Lost n' Found yet", "danger")
         return redirect('/')
     playlists = Playlist.query.filter(Playlist.user_id == user.id).all()
 
-    return render_template('lost-and-found.html', songs=songs, playlists=playlists, sort=sort)
+    return render_template('lost-and-found.html', songs=songs, playlists=playlists, sort=sort,
+                           next_rows=next_rows, song_playlists=True)
+
+
+@app.route('/lost-n-found/rows')
+def show_lost_and_found_rows():
+    """Returns the next page of Lost n' Found track rows as an HTML fragment"""
+
+    if not g.user:
+        abort(401)
+
+    sort = request.args.get('sort') or None
+    songs, next_rows = lost_and_found_rows(sort, decode_cursor(request.args.get('after')))
+    return render_template('track-rows.html', songs=songs, next_rows=next_rows, song_playlists=True)
+
+
+def lost_and_found_rows(sort, after):
+    limit = min(request.args.get('limit', LOST_AND_FOUND_PAGE_SIZE, type=int),
+                LOST_AND_FOUND_MAX_PAGE_SIZE)
+    songs, next_cursor = Song.page(sort=sort, after=after,
+                                   limit=max(limit, 1), user_id=g.user.id)
+    next_rows = None
+    if next_cursor is not None:
+        next_rows = url_for('show_lost_and_found_rows', sort=sort, after=encode_cursor(next_cursor),
+                            limit=request.args.get('limit', type=int))
+    return songs, next_rows
+
+
+@app.route('/songs/<int:song_id>/compatible')
+def show_compatible_songs(song_id):
+    """Returns JSON of songs that mix harmonically with a song, within
+    ?bpm_range= beats per minute of its tempo (or half/double its tempo)"""
+
+    if not g.user:
+        return redirect('/')
+
+    song = Song.query.get_or_404(song_id)
+    bpm_range = min(request.args.get('bpm_range', 6, type=int), 50)
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    half_double = request.args.get('half_double', 'true') != 'false'
+
+    matches = Song.harmonic_matches(song, bpm_range=bpm_range,
+                                    half_double=half_double, limit=limit)
+    return jsonify([{'id': match.id,
+                     'song_name': match.song_name,
+                     'song_seed': match.song_seed,
+                     'artist_name': match.artist_name,
+                     'bpm': match.bpm,
+                     'key': match.key_name,
+                     'camelot': match.camelot_label} for match in matches])
+
+
+def encode_cursor(cursor):
+    """Turns a (sort value, song id) page cursor into a query string value"""
+
+    if cursor is None:
+        return None
+    value, song_id = cursor
+    return f"{'' if value is None else value}:{song_id}"
+
+
+def decode_cursor(raw):
+    """Parses a cursor made by encode_cursor, returning None if it's invalid"""
+
+    if not raw:
+        return None
+    try:
+        value, song_id = raw.rsplit(':', 1)
+        value = int(value) if value else None
+        return value, int(song_id)
+    except ValueError:
+        return None
@@ -0,0 +1,114 @@
+"""Fingerprinted, precompressed static assets. At startup every file in static/
+is copied to the asset build directory under a name that includes a hash of
+its contents, along with gzip and brotli copies of text files. Templates link
+to them with asset_url(), and /assets/ serves them as immutable, in the
+encoding the browser accepts. A changed file gets a new URL, so browsers
+never need to revalidate an asset they already have."""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # only gzip copies are made
+    brotli = None
+
+# where fingerprinted copies are written (default build/assets next to app.py)
+ASSET_BUILD_DIR = os.environ.get('ASSET_BUILD_DIR')
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+# images are compressed already
+COMPRESSIBLE = {'.css', '.js', '.json', '.map', '.svg', '.txt'}
+# in order of preference, with the suffix of their precompressed copies
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def fingerprint(filename, content):
+    """Returns `filename` with a hash of `content` before its extension
+    ('style.css' -> 'style.0123456789ab.css')"""
+
+    base, ext = os.path.splitext(filename)
+    return f'{base}.{hashlib.sha256(content).hexdigest()[:12]}{ext}'
+
+
+def compress(content):
+    """Returns (suffix, compressed content) for each encoding that makes
+    `content` smaller"""
+
+    variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content, quality=11)))
+    return [(suffix, compressed) for suffix, compressed in variants
+            if len(compressed) < len(content)]
+
+
+def _write(path, content):
+    # a fingerprinted name always has the same content, so another worker
+    # process building at the same time writes identical bytes
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def build_assets(static_dir, build_dir):
+    """Writes a fingerprinted copy of every file in `static_dir`, and its
+    compressed copies, to `build_dir`. Returns {static filename:
+    fingerprinted filename}."""
+
+    manifest = {}
+    for root, _, files in os.walk(static_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                content = f.read()
+
+            manifest[filename] = fingerprint(filename, content)
+            out = os.path.join(build_dir, manifest[filename])
+            _write(out, content)
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+                for suffix, compressed in compress(content):
+                    _write(out + suffix, compressed)
+    return manifest
+
+
+def init_assets(app):
+    """Builds the app's assets and registers the asset_url() template helper
+    and the /assets/ route. In debug mode asset_url() links to /static/
+    instead, so edits show up without a restart."""
+
+    build_dir = ASSET_BUILD_DIR or os.path.join(app.root_path, 'build', 'assets')
+    manifest = {} if app.debug else build_assets(app.static_folder, build_dir)
+
+    @app.template_global()
+    def asset_url(filename):
+        if filename in manifest:
+            return f'/assets/{manifest[filename]}'
+        return url_for('static', filename=filename)
+
+    @app.route('/assets/<path:filename>')
+    def serve_asset(filename):
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        for encoding, suffix in ENCODINGS:
+            path = safe_join(build_dir, filename + suffix)
+            if request.accept_encodings.quality(encoding) > 0 and path and os.path.isfile(path):
+                resp = send_from_directory(build_dir, filename + suffix, mimetype=mimetype,
+                                           max_age=ASSET_MAX_AGE)
+                resp.headers['Content-Encoding'] = encoding
+                break
+        else:
+            resp = send_from_directory(build_dir, filename, mimetype=mimetype,
+                                       max_age=ASSET_MAX_AGE)
+        resp.vary.add('Accept-Encoding')
+        resp.cache_control.immutable = True
+        return resp
+
+    return manifest
@@ -0,0 +1,2 @@
+"""Offline benchmarks: a local Spotify stand-in, synthetic song catalogs and
+route timings stored as JSON baselines. See "Benchmarks" in README.md."""
@@ -0,0 +1,60 @@
+"""Synthetic song catalogs for benchmarks. Song n is the stub's track n, so
+recommendations from bench.spotify_stub are found in the songs table."""
+
+from datetime import datetime
+
+from bench.spotify_stub import ARTISTS, artist_id, features, track_id
+from harmonic import camelot_code, normalize_key
+from models import db, User, Playlist, PlaylistSong, Song
+
+INSERT_BATCH_SIZE = 10000
+
+BENCH_USERNAME = 'bench'
+BENCH_PASSWORD = 'bench-password'
+
+
+def song_row(n, now):
+    tempo, key, mode = features(n)
+    key = normalize_key(key)
+    return {'song_name': f'Track {n}',
+            'song_seed': track_id(n),
+            'artist_name': f'Artist {n % ARTISTS}',
+            'artist_seed': artist_id(n % ARTISTS),
+            'bpm': round(tempo),
+            'key': key,
+            'mode': mode,
+            'camelot': camelot_code(key, mode),
+            'last_seen': now}
+
+
+def grow_catalog(size, batch_size=INSERT_BATCH_SIZE):
+    """Inserts synthetic songs until the songs table holds tracks 0 to
+    `size` - 1. Returns the number of songs inserted."""
+
+    start = db.session.query(db.func.count(Song.id)).scalar()
+    now = datetime.utcnow()
+    for batch_start in range(start, size, batch_size):
+        rows = [song_row(n, now) for n in range(batch_start, min(batch_start + batch_size, size))]
+        db.session.execute(db.insert(Song), rows)
+        db.session.commit()
+    return max(size - start, 0)
+
+
+def bench_user(playlist_size=200):
+    """Returns the benchmark user, creating it with one playlist of
+    `playlist_size` songs and one empty playlist on first use"""
+
+    user = User.query.filter_by(username=BENCH_USERNAME).first()
+    if user:
+        return user
+
+    user = User.signup(BENCH_USERNAME, 'bench@example.com', BENCH_PASSWORD)
+    db.session.commit()
+    full = Playlist(name='Bench set', description='benchmark playlist', user_id=user.id)
+    empty = Playlist(name='Bench adds', description='benchmark playlist', user_id=user.id)
+    db.session.add_all([full, empty])
+    db.session.commit()
+
+    song_ids = [id for id, in db.session.query(Song.id).order_by(Song.id).limit(playlist_size)]
+    PlaylistSong.bulk_add(full.id, song_ids)
+    return user
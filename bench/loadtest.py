@@ -0,0 +1,298 @@
+"""Drives simulated users through scripted journeys against a local gunicorn
+and a latency-injecting Spotify stub, and reports throughput, tail latency
+and error rate per journey step.
+
+    python -m bench.loadtest --users 20 --duration 60 --workers 2
+    python -m bench.loadtest --users 50 --latency 0.2 --worker-class gthread --threads 4
+
+Each journey signs up a new user (or logs in as the demo user with --demo),
+searches, seeds a recommendation search, opens the results, creates a
+playlist, adds songs to it, sorts it and logs out. Runs against a throwaway
+SQLite database unless --database-url is given; SQLite serializes writes, so
+use PostgreSQL for numbers worth comparing."""
+
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import requests
+
+from bench.run import ROOT, percentile
+from bench.spotify_stub import GENRES
+
+STEPS = ['signup form', 'signup', 'search', 'seed form', 'seed', 'results',
+         'playlist form', 'create playlist', 'playlists', 'add', 'sort playlist', 'logout']
+SORTS = ['bpm', 'key', 'mix']
+DEMO_USERNAME = 'Test'
+DEMO_PASSWORD = 'test123'
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+SONG_ID = re.compile(r'name="songs" id="[^"]*" value="(\d+)"')
+PLAYLIST_ID = re.compile(r"href='/playlists/(\d+)'")
+
+
+class StepFailed(Exception):
+    pass
+
+
+class Recorder:
+    """Collects the latency and outcome of every step, from every user thread"""
+
+    def __init__(self):
+        self.seconds = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.journeys = 0
+        self._lock = threading.Lock()
+
+    def record(self, step, seconds, ok):
+        with self._lock:
+            self.seconds[step].append(seconds)
+            if not ok:
+                self.errors[step] += 1
+
+    def journey_done(self):
+        with self._lock:
+            self.journeys += 1
+
+    def summary(self, elapsed):
+        steps = {}
+        for step in STEPS:
+            seconds = self.seconds.get(step)
+            if not seconds:
+                continue
+            ms = [s * 1000 for s in seconds]
+            steps[step] = {'count': len(ms),
+                           'rps': round(len(ms) / elapsed, 2),
+                           'p50_ms': round(percentile(ms, 50), 1),
+                           'p95_ms': round(percentile(ms, 95), 1),
+                           'p99_ms': round(percentile(ms, 99), 1),
+                           'max_ms': round(max(ms), 1),
+                           'error_rate': round(self.errors[step] / len(ms), 4)}
+        return {'elapsed': round(elapsed, 1),
+                'journeys': self.journeys,
+                'journeys_per_second': round(self.journeys / elapsed, 2),
+                'steps': steps}
+
+
+class User:
+    """One simulated user with its own cookie session"""
+
+    def __init__(self, base_url, recorder, demo=False, think_time=0.0):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.demo = demo
+        self.think_time = think_time
+        self.http = requests.Session()
+
+    def step(self, name, method, path, **kwargs):
+        """Sends one request, timing it under `name`. Raises StepFailed on an
+        error status or a connection error so the journey stops there"""
+
+        kwargs.setdefault('allow_redirects', False)
+        kwargs.setdefault('timeout', 60)
+        started = time.perf_counter()
+        try:
+            resp = self.http.request(method, self.base_url + path, **kwargs)
+        except requests.RequestException as e:
+            self.recorder.record(name, time.perf_counter() - started, False)
+            raise StepFailed(f'{name}: {e}')
+
+        ok = resp.status_code < 400
+        self.recorder.record(name, time.perf_counter() - started, ok)
+        if not ok:
+            raise StepFailed(f'{name}: HTTP {resp.status_code}')
+        if self.think_time:
+            time.sleep(random.uniform(0, 2 * self.think_time))
+        return resp
+
+    def csrf_token(self, html):
+        match = CSRF_TOKEN.search(html)
+        return match.group(1) if match else ''
+
+    def journey(self):
+        self.http.cookies.clear()
+
+        if self.demo:
+            self.step('signup', 'GET', '/demo')
+        else:
+            token = self.csrf_token(self.step('signup form', 'GET', '/signup').text)
+            username = f'load-{uuid.uuid4().hex[:12]}'
+            self.step('signup', 'POST', '/signup', data={
+                'csrf_token': token, 'username': username,
+                'email': f'{username}@example.com', 'password': 'load-password'})
+
+        found = self.step('search', 'GET', '/search', params={
+            'q': f'track {random.randrange(1000)}', 'type': 'track'}).json()
+        tracks = [track['id'] for track in found['tracks']['items'][:random.randint(1, 4)]]
+
+        form = self.step('seed form', 'GET', '/seed').text
+        resp = self.step('seed', 'POST', '/seed', data={
+            'csrf_token': self.csrf_token(form), 'track': tracks,
+            'genre': random.choice(GENRES[1:]), 'key': '', 'mode': ''})
+        if '/results/' not in resp.headers.get('Location', ''):
+            raise StepFailed('seed: no results')
+
+        results = self.step('results', 'GET', resp.headers['Location']).text
+        song_ids = SONG_ID.findall(results)
+
+        form = self.step('playlist form', 'GET', '/playlist-create').text
+        self.step('create playlist', 'POST', '/playlist-create', data={
+            'csrf_token': self.csrf_token(form), 'name': 'Load test', 'description': ''})
+        playlist_ids = PLAYLIST_ID.findall(self.step('playlists', 'GET', '/playlists').text)
+        if not playlist_ids:
+            raise StepFailed('create playlist: no playlist')
+        playlist_id = max(playlist_ids, key=int)
+
+        self.step('add', 'POST', '/add', data={
+            'playlist': playlist_id,
+            'songs': random.sample(song_ids, min(len(song_ids), 10))})
+        self.step('sort playlist', 'GET', f'/playlists/{playlist_id}/{random.choice(SORTS)}')
+        self.step('logout', 'GET', '/logout')
+        self.recorder.journey_done()
+
+    def run(self, deadline):
+        while time.monotonic() < deadline:
+            try:
+                self.journey()
+            except StepFailed:
+                pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise SystemExit(f'{url} did not come up within {timeout}s')
+
+
+def prepare_database(env, catalog):
+    """Resets the database, seeds `catalog` songs and the demo user. Runs in a
+    subprocess so this process never imports the app with the wrong settings"""
+
+    script = f"""
+from flask_migrate import downgrade, upgrade
+from app import app
+from bench.catalog import grow_catalog
+from models import db, User
+with app.app_context():
+    downgrade(directory='migrations', revision='base')
+    upgrade(directory='migrations')
+    grow_catalog({catalog})
+    User.signup({DEMO_USERNAME!r}, 'demo@example.com', {DEMO_PASSWORD!r})
+    db.session.commit()
+"""
+    subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def print_summary(summary):
+    print(f"\n{summary['journeys']} journeys in {summary['elapsed']}s "
+          f"({summary['journeys_per_second']} journeys/s)")
+    print(f"  {'step':<16} {'count':>7} {'rps':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'errors':>7}")
+    for step, s in summary['steps'].items():
+        print(f"  {step:<16} {s['count']:>7} {s['rps']:>7.2f} {s['p50_ms']:>8.1f} {s['p95_ms']:>8.1f}"
+              f" {s['p99_ms']:>8.1f} {s['max_ms']:>8.1f} {s['error_rate']:>7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the app with simulated users')
+    parser.add_argument('--users', type=int, default=10, help='concurrent simulated users (default 10)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run for (default 60)')
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help='average seconds a user waits between steps (default 0)')
+    parser.add_argument('--demo', action='store_true', help='log in as the demo user instead of signing up')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers (default 2)')
+    parser.add_argument('--worker-class', default='sync', help='gunicorn worker class (default sync)')
+    parser.add_argument('--threads', type=int, default=1, help='threads per gunicorn worker (default 1)')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='seconds of Spotify stub latency per call (default 0.1)')
+    parser.add_argument('--jitter', type=float, default=0.2,
+                        help='stub latency varies by up to this fraction (default 0.2)')
+    parser.add_argument('--catalog', type=int, default=10000, help='synthetic songs to seed (default 10000)')
+    parser.add_argument('--database-url',
+                        help='database to run against, reset first (default: a temporary SQLite file)')
+    parser.add_argument('--out', help='write the summary to this JSON file')
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        path = os.path.join(tempfile.gettempdir(), 'crate-digger-load.db')
+        if os.path.exists(path):
+            os.remove(path)
+        database_url = f'sqlite:///{path}'
+
+    stub_port, app_port = free_port(), free_port()
+    stub_url = f'http://127.0.0.1:{stub_port}'
+    app_url = f'http://127.0.0.1:{app_port}'
+    env = {**os.environ,
+           'DATABASE_URL': database_url,
+           'SPOTIFY_API_URL': f'{stub_url}/v1',
+           'SPOTIFY_ACCOUNTS_URL': stub_url,
+           'SONG_SWEEP_INTERVAL': '0',
+           'PROMETHEUS_MULTIPROC_DIR': tempfile.mkdtemp(prefix='crate-digger-load-metrics-')}
+    env.pop('SQLALCHEMY_ECHO', None)
+
+    print(f'Seeding {args.catalog} songs...', file=sys.stderr)
+    prepare_database(env, args.catalog)
+
+    processes = [
+        subprocess.Popen([sys.executable, '-m', 'bench.spotify_stub', '--port', str(stub_port),
+                          '--latency', str(args.latency), '--jitter', str(args.jitter),
+                          '--catalog', str(args.catalog)],
+                         cwd=ROOT, env=env, stdout=subprocess.DEVNULL),
+        subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{app_port}',
+                          '--workers', str(args.workers), '--worker-class', args.worker_class,
+                          '--threads', str(args.threads), '--log-level', 'warning'],
+                         cwd=ROOT, env=env)]
+    try:
+        wait_for(f'{stub_url}/v1/recommendations/available-genre-seeds')
+        wait_for(f'{app_url}/login')
+        print(f'Running {args.users} users for {args.duration:g}s against {args.workers} '
+              f'{args.worker_class} worker(s), stub latency {args.latency}s', file=sys.stderr)
+
+        recorder = Recorder()
+        started = time.monotonic()
+        deadline = started + args.duration
+        users = [threading.Thread(target=User(app_url, recorder, args.demo, args.think_time).run,
+                                  args=(deadline,), daemon=True)
+                 for _ in range(args.users)]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        summary = recorder.summary(time.monotonic() - started)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    summary['config'] = {key: value for key, value in vars(args).items() if key != 'out'}
+    print_summary(summary)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
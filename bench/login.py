@@ -0,0 +1,115 @@
+"""Measures login throughput and latency at each bcrypt cost, to choose
+BCRYPT_LOG_ROUNDS for the hardware the app runs on.
+
+    python -m bench.login                            # costs 10 to 13
+    python -m bench.login --costs 8 10 12 --concurrency 8 --duration 20
+
+For each cost, concurrent threads post to /login through the Flask test
+client as a user whose password was hashed at that cost, so every login
+does one full bcrypt verification on the hashing pool."""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from bench.run import ROOT, percentile
+
+DEFAULT_COSTS = [10, 11, 12, 13]
+PASSWORD = 'bench-password'
+
+
+def time_logins(app, username, concurrency, duration):
+    """Logs in as `username` from `concurrency` threads for `duration`
+    seconds. Returns the latency of every login and the number that failed"""
+
+    seconds = []
+    failures = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def run():
+        client = app.test_client()
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            resp = client.post('/login', data={'username': username, 'password': PASSWORD})
+            elapsed = time.perf_counter() - started
+            with lock:
+                seconds.append(elapsed)
+                if resp.status_code != 302:
+                    failures.append(resp.status_code)
+            client.get('/logout')
+
+    threads = [threading.Thread(target=run, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return seconds, len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark login throughput per bcrypt cost')
+    parser.add_argument('--costs', type=int, nargs='+', default=DEFAULT_COSTS,
+                        help='bcrypt costs to measure (default 10 11 12 13)')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent logins (default 4)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per cost (default 10)')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.gettempdir(), 'crate-digger-login.db')
+    if os.path.exists(path):
+        os.remove(path)
+    # the app reads its settings on import
+    os.environ.update({'DATABASE_URL': f'sqlite:///{path}',
+                       'SONG_SWEEP_INTERVAL': '0',
+                       'QUERY_STATS_HEADERS': '0'})
+    os.environ.pop('SQLALCHEMY_ECHO', None)
+
+    from flask_migrate import upgrade
+
+    import passwords
+    from app import app
+    from models import db, User
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+
+    print(f'{args.concurrency} concurrent logins, {passwords.HASH_WORKERS} hashing threads, '
+          f'{os.cpu_count()} CPUs', file=sys.stderr)
+    print(f"  {'cost':>4} {'hash':>9} {'logins/s':>9} {'p50':>9} {'p95':>9} {'max':>9} {'failed':>7}")
+    results = {}
+    for cost in args.costs:
+        # logins must not rehash to another cost while they are being timed
+        passwords.BCRYPT_LOG_ROUNDS = cost
+        started = time.perf_counter()
+        with app.app_context():
+            User.signup(f'login-{cost}', f'login-{cost}@example.com', PASSWORD)
+            db.session.commit()
+        hash_ms = (time.perf_counter() - started) * 1000
+
+        seconds, failed = time_logins(app, f'login-{cost}', args.concurrency, args.duration)
+        ms = [s * 1000 for s in seconds]
+        results[cost] = {'hash_ms': round(hash_ms, 1),
+                         'logins': len(ms),
+                         'logins_per_second': round(len(ms) / args.duration, 2),
+                         'p50_ms': round(percentile(ms, 50), 1),
+                         'p95_ms': round(percentile(ms, 95), 1),
+                         'max_ms': round(max(ms), 1),
+                         'failed': failed}
+        r = results[cost]
+        print(f"  {cost:>4} {r['hash_ms']:>9.1f} {r['logins_per_second']:>9.2f} {r['p50_ms']:>9.1f}"
+              f" {r['p95_ms']:>9.1f} {r['max_ms']:>9.1f} {r['failed']:>7}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'concurrency': args.concurrency, 'hash_workers': passwords.HASH_WORKERS,
+                       'cpus': os.cpu_count(), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""Times the app's main routes against a local Spotify stub and synthetic
+catalogs, and saves the timings as a JSON baseline.
+
+    python -m bench.run                                  # 1K, 100K and 1M songs
+    python -m bench.run --sizes 1000 100000 --repeat 20
+    python -m bench.run --compare bench/baselines/<commit>.json
+
+Runs against a throwaway SQLite database unless --database-url is given; the
+database is reset before the run."""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from bench.spotify_stub import start_stub, track_id
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT, 'bench', 'baselines')
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+PLAYLIST_SORTS = ['', '/bpm', '/key', '/mix']
+LOST_AND_FOUND_SORTS = ['', '/bpm', '/key']
+# regressions smaller than this many milliseconds are treated as noise
+NOISE_FLOOR_MS = 1.0
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(seconds, queries, errors):
+    ms = [s * 1000 for s in seconds]
+    return {'n': len(ms),
+            'mean_ms': round(sum(ms) / len(ms), 2),
+            'p50_ms': round(percentile(ms, 50), 2),
+            'p95_ms': round(percentile(ms, 95), 2),
+            'max_ms': round(max(ms), 2),
+            'queries': percentile(queries, 50) if queries else None,
+            'errors': errors}
+
+
+def time_routes(app, user_id, playlist_id, scratch_playlist_id, repeat):
+    """Requests each route `repeat` times with the test client and returns
+    {route: summary}. In-memory caches are cleared where a route would
+    otherwise only measure a cache hit."""
+
+    from client import recommendation_cache
+    from features import features_cache
+    from setorder import set_order_cache
+    from utilities import search_cache
+
+    client = app.test_client()
+    seconds = defaultdict(list)
+    queries = defaultdict(list)
+    errors = defaultdict(int)
+
+    def login():
+        with client.session_transaction() as session:
+            session['curr_user'] = user_id
+
+    def timed(route, send):
+        started = time.perf_counter()
+        resp = send()
+        seconds[route].append(time.perf_counter() - started)
+        if resp.status_code >= 400:
+            errors[route] += 1
+        if 'X-Query-Count' in resp.headers:
+            queries[route].append(int(resp.headers['X-Query-Count']))
+        return resp
+
+    login()
+    for i in range(repeat):
+        search = {'track': [track_id(i * 3), track_id(i * 3 + 1)], 'genre': 'house',
+                  'key': '', 'mode': ''}
+
+        recommendation_cache.clear()
+        features_cache.clear()
+        resp = timed('POST /seed', lambda: client.post('/seed', data={**search, 'refresh': '1'}))
+        timed('POST /seed (cached)', lambda: client.post('/seed', data=search))
+        timed('GET /results/<id>', lambda: client.get(resp.location))
+
+        search_cache.clear()
+        timed('GET /search', lambda: client.get('/search', query_string={'q': f'track {i}', 'type': 'track'}))
+
+        for sort in PLAYLIST_SORTS:
+            set_order_cache.clear()
+            timed(f'GET /playlists/<id>{sort}', lambda: client.get(f'/playlists/{playlist_id}{sort}'))
+
+        for sort in LOST_AND_FOUND_SORTS:
+            timed(f'GET /lost-n-found{sort}', lambda: client.get(f'/lost-n-found{sort}'))
+
+        songs = [str(id) for id in range(i * 10 + 1, i * 10 + 11)]
+        timed('POST /add', lambda: client.post('/add', data={'playlist': scratch_playlist_id,
+                                                            'songs': songs}))
+
+        timed('GET /logout', lambda: client.get('/logout'))
+        login()
+
+    return {route: summarize(seconds[route], queries[route], errors[route]) for route in seconds}
+
+
+def compare(old, new, tolerance):
+    """Prints the p50 change of every route in both reports. Returns a list of
+    (size, route, old p50, new p50) for routes more than `tolerance` slower"""
+
+    regressions = []
+    print(f"\nCompared with {old['meta'].get('commit')} ({old['meta'].get('created')}):")
+    for size, routes in new['results'].items():
+        for route, summary in routes.items():
+            before = old['results'].get(size, {}).get(route)
+            if not before:
+                continue
+            change = summary['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0
+            slower = change > tolerance and summary['p50_ms'] - before['p50_ms'] > NOISE_FLOOR_MS
+            if slower:
+                regressions.append((size, route, before['p50_ms'], summary['p50_ms']))
+            print(f"  {size:>8} {route:<28} {before['p50_ms']:>9.2f} -> {summary['p50_ms']:>9.2f} ms"
+                  f" {change:+7.1%}{'  REGRESSION' if slower else ''}")
+    return regressions
+
+
+def print_report(report):
+    for size, routes in report['results'].items():
+        print(f"\n{size} songs")
+        print(f"  {'route':<28} {'p50':>9} {'p95':>9} {'max':>9} {'queries':>8} {'errors':>7}")
+        for route, s in routes.items():
+            print(f"  {route:<28} {s['p50_ms']:>9.2f} {s['p95_ms']:>9.2f} {s['max_ms']:>9.2f}"
+                  f" {s['queries'] if s['queries'] is not None else '-':>8} {s['errors']:>7}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the main routes offline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='catalog sizes to benchmark, smallest first (default 1000 100000 1000000)')
+    parser.add_argument('--repeat', type=int, default=10, help='requests per route and size (default 10)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds of Spotify stub latency per call (default 0.05)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='stub latency varies by up to this fraction (default 0)')
+    parser.add_argument('--database-url',
+                        help='database to run against, reset first (default: a temporary SQLite file)')
+    parser.add_argument('--out', help='baseline file to write (default bench/baselines/<commit>.json)')
+    parser.add_argument('--compare', help='baseline file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='p50 slowdown that counts as a regression (default 0.2)')
+    args = parser.parse_args()
+
+    stub = start_stub(latency=args.latency, jitter=args.jitter)
+    stub_url = f'http://127.0.0.1:{stub.server_port}'
+    database_url = args.database_url
+    if not database_url:
+        path = os.path.join(tempfile.gettempdir(), 'crate-digger-bench.db')
+        if os.path.exists(path):
+            os.remove(path)
+        database_url = f'sqlite:///{path}'
+
+    # the app reads its settings on import
+    os.environ.update({'DATABASE_URL': database_url,
+                       'SPOTIFY_API_URL': f'{stub_url}/v1',
+                       'SPOTIFY_ACCOUNTS_URL': stub_url,
+                       'SPOTIFY_TOKEN_STORE': 'memory',
+                       'SONG_SWEEP_INTERVAL': '0'})
+    os.environ.pop('SQLALCHEMY_ECHO', None)
+
+    from flask_migrate import downgrade, upgrade
+
+    from app import app
+    from bench.catalog import bench_user, grow_catalog
+    from models import db, Playlist
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    migrations = os.path.join(ROOT, 'migrations')
+
+    with app.app_context():
+        downgrade(directory=migrations, revision='base')
+        upgrade(directory=migrations)
+        dialect = db.engine.dialect.name
+
+    report = {'meta': {'commit': git_commit(),
+                       'created': datetime.utcnow().isoformat(timespec='seconds'),
+                       'python': platform.python_version(),
+                       'database': dialect,
+                       'latency': args.latency,
+                       'jitter': args.jitter,
+                       'repeat': args.repeat},
+              'results': {}}
+
+    for size in sorted(args.sizes):
+        started = time.perf_counter()
+        with app.app_context():
+            grow_catalog(size)
+            user = bench_user()
+            playlist_id, scratch_playlist_id = [p.id for p in Playlist.query.filter_by(
+                user_id=user.id).order_by(Playlist.id)]
+            user_id = user.id
+        print(f'Seeded {size} songs in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+        stub.catalog = size
+        report['results'][str(size)] = time_routes(app, user_id, playlist_id, scratch_playlist_id,
+                                                   args.repeat)
+
+    stub.shutdown()
+    print_report(report)
+
+    out = args.out or os.path.join(BASELINE_DIR, f"{report['meta']['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nSaved {out}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
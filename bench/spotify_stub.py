@@ -0,0 +1,209 @@
+"""A local stand-in for the Spotify endpoints the app calls, for benchmarks
+and load tests that must not touch the real API.
+
+Tracks form an endless synthetic catalog: track number n has the id
+track_id(n) and the tempo, key and mode from features(n), so songs seeded
+into the database by bench.catalog match what the stub recommends.
+
+Run it on its own with `python -m bench.spotify_stub --port 8900 --latency 0.05`
+and point SPOTIFY_API_URL at http://127.0.0.1:8900/v1 and
+SPOTIFY_ACCOUNTS_URL at http://127.0.0.1:8900."""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+GENRES = ['acoustic', 'afrobeat', 'ambient', 'breakbeat', 'chicago-house', 'deep-house',
+          'detroit-techno', 'disco', 'drum-and-bass', 'dub', 'dubstep', 'edm', 'electro',
+          'funk', 'garage', 'hip-hop', 'house', 'jazz', 'minimal-techno', 'soul', 'techno',
+          'trance']
+GENRES_ETAG = '"stub-genres-1"'
+
+# Spotify's limits
+MAX_SEEDS = 5
+MAX_AUDIO_FEATURE_IDS = 100
+
+ARTISTS = 1000
+
+
+def track_id(n):
+    """Returns the 22 character Spotify-style id of track number `n`"""
+
+    return f'stubtrack{n:013d}'
+
+
+def track_number(id):
+    """Returns the track number of a track_id(), or None for other ids"""
+
+    if id.startswith('stubtrack') and id[9:].isdigit():
+        return int(id[9:])
+    return None
+
+
+def artist_id(n):
+    return f'stubartist{n:012d}'
+
+
+def features(n):
+    """Returns (tempo, key, mode) of track number `n`. Every 50th track has
+    no detected key, like some real tracks."""
+
+    tempo = 70 + (n * 37) % 111 + (n % 10) / 10
+    key = -1 if n % 50 == 49 else (n * 7) % 12
+    return tempo, key, (n // 3) % 2
+
+
+def track(n):
+    return {'id': track_id(n),
+            'name': f'Track {n}',
+            'popularity': n % 100,
+            'duration_ms': 180000 + (n % 120) * 1000,
+            'album': {'name': f'Album {n // 10}', 'images': []},
+            'artists': [{'id': artist_id(n % ARTISTS), 'name': f'Artist {n % ARTISTS}'}]}
+
+
+class SpotifyStubHandler(BaseHTTPRequestHandler):
+    """Serves the stub endpoints, sleeping `server.latency` seconds (give or
+    take `server.jitter` of it) before each response. Search results and
+    recommendations are drawn from the first `server.catalog` tracks."""
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self.dispatch()
+
+    def dispatch(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        latency = self.server.latency * random.uniform(1 - self.server.jitter, 1 + self.server.jitter)
+        time.sleep(max(latency, 0))
+
+        routes = {'/api/token': self.token,
+                  '/v1/search': self.search,
+                  '/v1/recommendations': self.recommendations,
+                  '/v1/recommendations/available-genre-seeds': self.genres,
+                  '/v1/audio-features': self.audio_features}
+        handler = routes.get(url.path)
+        if handler is None:
+            return self.reply(404, {'error': {'status': 404, 'message': 'Not found'}})
+        handler(params)
+
+    def token(self, params):
+        self.reply(200, {'access_token': 'stub-token', 'token_type': 'Bearer', 'expires_in': 3600})
+
+    def search(self, params):
+        type = params.get('type')
+        if type not in ('artist', 'track'):
+            return self.reply(400, {'error': {'status': 400, 'message': 'Bad search type'}})
+
+        start = int(hashlib.md5(params.get('q', '').encode()).hexdigest(), 16) % self.server.catalog
+        limit = int(params.get('limit', 20))
+        if type == 'artist':
+            items = [{'id': artist_id((start + i) % ARTISTS), 'name': f'Artist {(start + i) % ARTISTS}',
+                      'popularity': 50, 'genres': [], 'images': []}
+                     for i in range(limit)]
+        else:
+            items = [track((start + i) % self.server.catalog) for i in range(limit)]
+        self.reply(200, {f'{type}s': {'href': self.path, 'total': 1000, 'items': items}})
+
+    def recommendations(self, params):
+        seeds = sorted(seed for kind in ('seed_artists', 'seed_tracks', 'seed_genres')
+                       for seed in params.get(kind, '').split(',') if seed)
+        if not seeds or len(seeds) > MAX_SEEDS:
+            return self.reply(400, {'error': {'status': 400, 'message': 'Invalid number of seeds'}})
+
+        start = int(hashlib.md5(','.join(seeds).encode()).hexdigest(), 16) % self.server.catalog
+        limit = int(params.get('limit', 20))
+        self.reply(200, {'seeds': [{'id': seed} for seed in seeds],
+                         'tracks': [track((start + i * 7) % self.server.catalog) for i in range(limit)]})
+
+    def genres(self, params):
+        if self.headers.get('If-None-Match') == GENRES_ETAG:
+            return self.reply(304, None)
+        self.reply(200, {'genres': GENRES}, {'ETag': GENRES_ETAG})
+
+    def audio_features(self, params):
+        ids = [id for id in params.get('ids', '').split(',') if id]
+        if not ids or len(ids) > MAX_AUDIO_FEATURE_IDS:
+            return self.reply(400, {'error': {'status': 400, 'message': 'Invalid ids'}})
+
+        results = []
+        for id in ids:
+            n = track_number(id)
+            if n is None:
+                results.append(None)
+                continue
+            tempo, key, mode = features(n)
+            results.append({'id': id, 'tempo': tempo, 'key': key, 'mode': mode})
+        self.reply(200, {'audio_features': results})
+
+    def reply(self, status, body, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(latency=0.0, jitter=0.0, catalog=1000, host='127.0.0.1', port=0):
+    """Returns a stub server bound to `host`:`port` (0 picks a free port)"""
+
+    server = ThreadingHTTPServer((host, port), SpotifyStubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.catalog = catalog
+    return server
+
+
+def start_stub(latency=0.0, jitter=0.0, catalog=1000, host='127.0.0.1', port=0):
+    """Starts the stub on a background thread. Returns the server; its base
+    url is f'http://{host}:{server.server_port}'"""
+
+    server = make_server(latency, jitter, catalog, host, port)
+    threading.Thread(target=server.serve_forever, name='spotify-stub', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the Spotify API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds added to every response (default 0.05)')
+    parser.add_argument('--jitter', type=float, default=0.2,
+                        help='latency varies by up to this fraction either way (default 0.2)')
+    parser.add_argument('--catalog', type=int, default=1000,
+                        help='recommend tracks from the first N catalog tracks (default 1000)')
+    args = parser.parse_args()
+
+    server = make_server(args.latency, args.jitter, args.catalog, args.host, args.port)
+    print(f'Spotify stub on http://{args.host}:{server.server_port} '
+          f'(latency {args.latency}s +/- {args.jitter:.0%})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import cache_lookup
+
+# seconds to wait before retrying a failed refresh
+REFRESH_RETRY_DELAY = 30
+
+logger = logging.getLogger(__name__)
+
+
+class RevalidatingCache:
+    """Process-wide cache for a single slow-changing value (e.g. Spotify's
+    genre seed list).
+
+    The value is served from memory until it expires. Shortly before expiry a
+    background thread refreshes it, sending the last ETag so the upstream can
+    answer 304 Not Modified. If a refresh fails, or is still running, the
+    stale value keeps being served rather than failing or holding up the
+    request. A `name` enables hit/miss metrics."""
+
+    def __init__(self, ttl, refresh_ahead, name=None):
+        self.name = name
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.value = None
+        self.etag = None
+        self.expires_at = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._retry_at = 0
+
+    def get(self, fetch):
+        """Return the cached value, fetching it with `fetch` if needed.
+
+        `fetch(etag)` returns a tuple of (value, etag). It should return a value
+        of None when the upstream reports the cached copy is still current."""
+
+        now = time.monotonic()
+        if self.name:
+            cache_lookup(self.name, self.value is not None and now < self.expires_at)
+
+        if self.value is None:
+            with self._lock:
+                if self.value is None:
+                    self._refresh(fetch)
+            return self.value
+
+        if now >= self.expires_at:
+            # while another thread refreshes, serve the stale copy rather than
+            # waiting out a slow or failing upstream
+            if not self._lock.acquire(blocking=False):
+                return self.value
+            try:
+                if time.monotonic() >= self.expires_at:
+                    self._refresh(fetch)
+            except Exception:
+                # serve stale data if Spotify is unavailable, retry shortly
+                logger.exception('Refreshing %s failed, serving the cached copy', self.name or 'cache')
+                self.expires_at = time.monotonic() + self.refresh_ahead
+                self._retry_at = time.monotonic() + REFRESH_RETRY_DELAY
+            finally:
+                self._lock.release()
+            return self.value
+
+        if (now >= self.expires_at - self.refresh_ahead and not self._refreshing
+                and now >= self._retry_at):
+            self._refreshing = True
+            threading.Thread(target=self._background_refresh,
+                             args=(fetch,), daemon=True).start()
+
+        return self.value
+
+    def clear(self):
+        """Drop the cached value, forcing the next get() to fetch it again"""
+
+        with self._lock:
+            self.value = None
+            self.etag = None
+            self.expires_at = 0
+            self._retry_at = 0
+
+    def _refresh(self, fetch):
+        value, etag = fetch(self.etag if self.value is not None else None)
+        if value is not None:
+            self.value = value
+        self.etag = etag or self.etag
+        self.expires_at = time.monotonic() + self.ttl
+
+    def _background_refresh(self, fetch):
+        try:
+            with self._lock:
+                self._refresh(fetch)
+        except Exception:
+            logger.exception('Background refresh of %s failed', self.name or 'cache')
+            self._retry_at = time.monotonic() + REFRESH_RETRY_DELAY
+        finally:
+            self._refreshing = False
+
+
+class LRUCache:
+    """Thread-safe, size-bounded mapping that evicts the least recently used
+    key. If `ttl` is given, entries also expire that many seconds after being set.
+    A `name` enables hit/miss metrics."""
+
+    def __init__(self, maxsize, ttl=None, name=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._get(key, default)
+        if self.name:
+            cache_lookup(self.name, value is not default)
+        return value
+
+    def _get(self, key, default):
+        try:
+            expires_at, value = self._data[key]
+        except KeyError:
+            return default
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key: while one thread runs
+    `fn`, other threads asking for the same key wait and share its result."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
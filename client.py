@@ -1,25 +1,143 @@
-from flask import Flask, session
-from access import CLIENT_ID, CLIENT_SECRET
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache import LRUCache
+from tokens import token_manager
+from transport import SPOTIFY_API_URL
+import transport
+import hashlib
+import json
+import os
+
+# Spotify accepts at most 5 seeds (artists, tracks and genres combined) per request
+MAX_SEEDS = 5
+SEED_KINDS = ('seed_genres', 'seed_artists', 'seed_tracks')
+RECOMMENDATION_WORKERS = int(os.environ.get('RECOMMENDATION_WORKERS', 5))
+MAX_RECOMMENDATIONS = 100
+# Spotify accepts at most 100 ids per /audio-features request
+AUDIO_FEATURES_BATCH_SIZE = 100
+AUDIO_FEATURES_WORKERS = int(os.environ.get('AUDIO_FEATURES_WORKERS', 4))
+RECOMMENDATION_CACHE_TTL = int(os.environ.get('RECOMMENDATION_CACHE_TTL', 3600))
+RECOMMENDATION_CACHE_SIZE = int(os.environ.get('RECOMMENDATION_CACHE_SIZE', 1024))
+
+# maps payload_key(payload) to the track ids recommended for that payload
+recommendation_cache = LRUCache(maxsize=RECOMMENDATION_CACHE_SIZE,
+                                ttl=RECOMMENDATION_CACHE_TTL, name='recommendations')
 
 
 class SpotifyClient:
     """methods for retrieving necessary data from Spotify API"""
 
-    def __init__(self, payload, headers):
+    def __init__(self, payload=None, headers=None):
         self.payload = payload
-        self.headers = headers
+        self.headers = headers or token_manager.headers()
 
     def get_recommendations(self):
-        resp = requests.get(
-            'https://api.spotify.com/v1/recommendations',
-            params=self.payload,
-            headers=self.headers).json()
-        return resp
+        """Returns recommendations for the payload. Payloads with more seeds
+        than one request allows are fanned out, see get_recommendations_fanout"""
+
+        groups = partition_seeds(self.payload)
+        if len(groups) > 1:
+            return self.get_recommendations_fanout(groups)
 
-    def get_bpms(self):
-        resp = requests.get(
-            'https://api.spotify.com/v1/audio-features',
+        resp = transport.get(
+            f'{SPOTIFY_API_URL}/recommendations',
             params=self.payload,
             headers=self.headers).json()
         return resp
+
+    def get_recommendations_fanout(self, groups):
+        """Requests recommendations for each group of seeds concurrently and
+        merges them into one response. Tracks recommended by more groups rank
+        first, then tracks Spotify ranked higher within their group."""
+
+        params = {key: value for key, value in self.payload.items()
+                  if key not in SEED_KINDS}
+
+        def fetch(seeds):
+            return transport.get(
+                f'{SPOTIFY_API_URL}/recommendations',
+                params={**params, **seeds},
+                headers=self.headers).json()
+
+        with ThreadPoolExecutor(max_workers=min(len(groups), RECOMMENDATION_WORKERS)) as pool:
+            responses = list(pool.map(fetch, groups))
+
+        ok = [resp for resp in responses if 'tracks' in resp]
+        if not ok:
+            return responses[0]
+
+        tracks = {}
+        votes = {}
+        best_rank = {}
+        for resp in ok:
+            for rank, track in enumerate(resp['tracks']):
+                tracks.setdefault(track['id'], track)
+                votes[track['id']] = votes.get(track['id'], 0) + 1
+                best_rank[track['id']] = min(best_rank.get(track['id'], rank), rank)
+
+        ranked = sorted(tracks, key=lambda id: (-votes[id], best_rank[id]))
+        return {'tracks': [tracks[id] for id in ranked[:MAX_RECOMMENDATIONS]]}
+
+    def iter_audio_features(self, track_ids):
+        """Yields (track_id, features) for each track id as its batch arrives.
+        `features` is Spotify's audio features dict, or None for tracks Spotify
+        has no features for.
+
+        Ids are requested in batches of at most 100, fetched concurrently on up
+        to AUDIO_FEATURES_WORKERS threads."""
+
+        batches = [track_ids[start:start + AUDIO_FEATURES_BATCH_SIZE]
+                   for start in range(0, len(track_ids), AUDIO_FEATURES_BATCH_SIZE)]
+        if not batches:
+            return
+
+        def fetch(batch):
+            return batch, transport.get(
+                f'{SPOTIFY_API_URL}/audio-features',
+                params={'ids': ','.join(batch)},
+                headers=self.headers).json()
+
+        with ThreadPoolExecutor(max_workers=min(len(batches), AUDIO_FEATURES_WORKERS)) as pool:
+            for future in as_completed([pool.submit(fetch, batch) for batch in batches]):
+                batch, resp = future.result()
+                # results line up with the requested ids, null for unknown ids
+                yield from zip(batch, resp['audio_features'])
+
+
+def partition_seeds(payload):
+    """Splits a payload's comma separated seeds into groups that each fit in
+    one recommendations request. Returns a list of {seed kind: 'id,id'} dicts.
+
+    When the seeds need more than one request, the genre seed is repeated in
+    every group so each request stays in the chosen genre."""
+
+    # a seed repeated in the form would otherwise cost a slot, or a request
+    seeds = {kind: list(dict.fromkeys(seed for seed in payload.get(kind, '').split(',') if seed))
+             for kind in SEED_KINDS}
+    if sum(len(ids) for ids in seeds.values()) <= MAX_SEEDS:
+        return [{kind: ','.join(ids) for kind, ids in seeds.items() if ids}]
+
+    genres = seeds.pop('seed_genres')[:MAX_SEEDS - 1]
+    others = [(kind, seed) for kind, ids in seeds.items() for seed in ids]
+    size = MAX_SEEDS - len(genres)
+
+    groups = []
+    for start in range(0, len(others), size):
+        group = {'seed_genres': genres} if genres else {}
+        for kind, seed in others[start:start + size]:
+            group.setdefault(kind, []).append(seed)
+        groups.append({kind: ','.join(ids) for kind, ids in group.items()})
+    return groups
+
+
+def payload_key(payload):
+    """Returns a digest that is the same for every payload asking for the same
+    recommendations: seeds are deduplicated and sorted, float targets rounded"""
+
+    canonical = {}
+    for key, value in payload.items():
+        if key in SEED_KINDS:
+            value = sorted({seed for seed in value.split(',') if seed})
+        elif isinstance(value, float):
+            value = round(value, 1)
+        canonical[key] = value
+    return hashlib.sha1(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
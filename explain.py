@@ -0,0 +1,79 @@
+from datetime import datetime
+
+from models import db, Song, Playlist, PlaylistSong, SearchResult
+from sweeper import orphan_songs_query
+
+
+def route_queries():
+    """Returns (description, statement, index names, avoided index names)
+    for the queries behind the app's main routes. The plan passes when any
+    one of the index names shows up in it and none of the avoided ones do;
+    SQLite names the indexes behind unique constraints
+    sqlite_autoindex_<table>_<n>."""
+
+    return [
+        ("lost-n-found sorted by bpm",
+         Song.page_query('bpm', (120, 1)).limit(51).statement,
+         ['ix_songs_bpm_id'], []),
+        ("lost-n-found sorted by key",
+         Song.page_query('key', (14, 1)).limit(51).statement,
+         ['ix_songs_camelot_id'], []),
+        ("harmonically compatible songs",
+         Song.harmonic_matches_query(Song(id=1, bpm=120, camelot=14)).limit(50).statement,
+         ['ix_songs_camelot_bpm'],
+         # matching the key alone and filtering the tempo row by row
+         ['ix_songs_camelot_id']),
+        ("playlists with track counts",
+         Playlist.song_counts_query(1).statement,
+         ['ix_playlists_user_id_id'], []),
+        ("playlist songs",
+         db.select(Song).join(PlaylistSong, PlaylistSong.song_id == Song.id)
+         .where(PlaylistSong.playlist_id == 1),
+         ['uq_playlist_song', 'sqlite_autoindex_playlists_songs'], []),
+        ("stored audio features",
+         db.select(Song.song_seed, Song.bpm, Song.key, Song.mode)
+         .where(Song.song_seed.in_(['a', 'b'])),
+         ['songs_song_seed_key', 'sqlite_autoindex_songs'], []),
+        ("orphan song sweep",
+         orphan_songs_query(datetime.utcnow()).limit(1000),
+         ['ix_playlists_songs_song_id'], []),
+        ("stored search result sweep",
+         db.delete(SearchResult).where(SearchResult.created_at < datetime.utcnow()),
+         ['ix_search_results_created_at'], []),
+    ]
+
+
+def explain(conn, statement):
+    """Returns the database's query plan for `statement` as a string"""
+
+    compiled = statement.compile(dialect=conn.dialect,
+                                 compile_kwargs={'render_postcompile': True})
+    if conn.dialect.name == 'sqlite':
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+        rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params)
+        return '\n'.join(row[-1] for row in rows)
+
+    rows = conn.exec_driver_sql(f'EXPLAIN {compiled}', compiled.params)
+    return '\n'.join(row[0] for row in rows)
+
+
+def check_query_plans():
+    """EXPLAINs every route query and returns a list of
+    (description, passed, plan) tuples, passed being True when the plan uses
+    one of the query's expected indexes and none of its avoided ones"""
+
+    results = []
+    with db.engine.connect() as conn:
+        with conn.begin() as trans:
+            if conn.dialect.name == 'postgresql':
+                # on small tables the planner prefers sequential scans, which
+                # would hide whether an index is usable at all
+                conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+            for description, statement, indexes, avoided in route_queries():
+                plan = explain(conn, statement)
+                results.append((description,
+                                any(index in plan for index in indexes)
+                                and not any(index in plan for index in avoided),
+                                plan))
+            trans.rollback()
+    return results
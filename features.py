@@ -0,0 +1,70 @@
+import os
+
+from models import db, Song
+from client import SpotifyClient
+from cache import LRUCache
+from harmonic import normalize_key
+
+AUDIO_FEATURES_CACHE_SIZE = int(
+    os.environ.get('AUDIO_FEATURES_CACHE_SIZE', 10000))
+
+# maps a Spotify track id to its [bpm, key, mode], key as a pitch class (None if unknown)
+features_cache = LRUCache(maxsize=AUDIO_FEATURES_CACHE_SIZE, name='audio_features')
+
+UNKNOWN_FEATURES = (None, None, None)
+
+
+def get_audio_features(track_ids):
+    """Returns a dict of {track_id: [bpm, key, mode]} for the given Spotify track ids.
+    Tracks Spotify has no features for map to [None, None, None]."""
+
+    return dict(iter_audio_features(track_ids))
+
+
+def iter_audio_features(track_ids):
+    """Yields (track_id, [bpm, key, mode]) for the given Spotify track ids.
+
+    Features are looked up in memory first, then in the songs table, and only
+    the remaining tracks are requested from Spotify's /audio-features, in
+    batches whose results are yielded as each one arrives."""
+
+    misses = []
+    for track_id in track_ids:
+        cached = features_cache.get(track_id)
+        if cached is None:
+            misses.append(track_id)
+        else:
+            yield track_id, cached
+
+    if misses:
+        stored = lookup_stored_features(misses)
+        for track_id, features in stored.items():
+            features_cache.set(track_id, features)
+            yield track_id, features
+        misses = [track_id for track_id in misses if track_id not in stored]
+    if not misses:
+        # don't fetch a token for a request that won't be made
+        return
+
+    for track_id, track in SpotifyClient().iter_audio_features(misses):
+        if track is None:
+            # not cached, Spotify may analyze the track later
+            yield track_id, list(UNKNOWN_FEATURES)
+            continue
+        fetched = [round(track['tempo']),
+                   normalize_key(track['key']), track['mode']]
+        features_cache.set(track_id, fetched)
+        yield track_id, fetched
+
+
+def lookup_stored_features(track_ids):
+    """Returns {track_id: [bpm, key, mode]} for tracks already saved with a bpm
+    and mode. Reads on a connection of its own, returned to the pool before
+    the remaining tracks are requested from Spotify."""
+
+    with db.engine.connect() as conn:
+        rows = conn.execute(db.select(Song.song_seed, Song.bpm, Song.key, Song.mode).where(
+            Song.song_seed.in_(track_ids),
+            Song.bpm.isnot(None),
+            Song.mode.isnot(None))).all()
+    return {song_seed: [bpm, key, mode] for song_seed, bpm, key, mode in rows}
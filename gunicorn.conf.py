@@ -0,0 +1,49 @@
+"""gunicorn settings, loaded automatically by `gunicorn app:app`"""
+
+import os
+import shutil
+
+# metrics from every worker are written here and aggregated by /metrics. This
+# has to be set before prometheus_client is imported, by the master and by
+# the workers forked from it.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/crate-digger-metrics')
+
+from prometheus_client import multiprocess  # noqa: E402
+
+from pools import pool_sizes  # noqa: E402
+
+# 'sync' serves one request per worker; 'gevent' serves up to
+# worker_connections requests per worker, switching while they wait on
+# Spotify or the database
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+COOPERATIVE_WORKERS = ('gevent', 'gevent_wsgi', 'gevent_pywsgi')
+
+
+def on_starting(server):
+    # metric files left over from a previous run would be counted again
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def post_fork(server, worker):
+    cfg = server.cfg
+    cooperative = cfg.worker_class_str in COOPERATIVE_WORKERS
+    if cooperative:
+        # psycopg2 is a C extension that gevent's monkey patching can't reach;
+        # this makes it yield to other greenlets while waiting on Postgres
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+    # the app isn't preloaded, so the worker reads these when it imports it
+    db_pool_size, db_max_overflow, http_pool_size = pool_sizes(
+        cfg.workers, cfg.worker_connections if cooperative else cfg.threads)
+    os.environ.setdefault('DB_POOL_SIZE', str(db_pool_size))
+    os.environ.setdefault('DB_MAX_OVERFLOW', str(db_max_overflow))
+    os.environ.setdefault('HTTP_POOL_SIZE', str(http_pool_size))
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,57 @@
+"""Musical key helpers: Spotify pitch classes and modes, and the Camelot wheel
+DJs use to find harmonically compatible tracks.
+
+Spotify describes a track's key as a pitch class (0 = C, 1 = C#, ... 11 = B,
+-1 when no key was detected) and its mode as 1 for major, 0 for minor.
+
+A Camelot code is stored as a small integer from 0 to 23, ordered around the
+wheel: code // 2 + 1 is the wheel number (1-12) and code % 2 is the letter
+(0 = A/minor, 1 = B/major). Sorting by code gives 1A, 1B, 2A, 2B, ..."""
+
+KEY_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+
+def normalize_key(key):
+    """Returns Spotify's pitch class as stored on a song, None if unknown"""
+
+    if key is None or key < 0 or key > 11:
+        return None
+    return key
+
+
+def key_name(key, mode=None):
+    """Returns a display name like 'C#' for major keys or 'C#m' for minor"""
+
+    if key is None:
+        return ''
+    return KEY_NAMES[key] + ('m' if mode == 0 else '')
+
+
+def camelot_code(key, mode):
+    """Returns the Camelot code (0-23) for a pitch class and mode, or None"""
+
+    if normalize_key(key) is None or mode not in (0, 1):
+        return None
+    # minor keys share a wheel number with their relative major, 3 semitones up
+    major_key = key if mode == 1 else (key + 3) % 12
+    number = (7 * major_key + 7) % 12
+    return number * 2 + mode
+
+
+def camelot_label(code):
+    """Returns the wheel label for a Camelot code, e.g. '8A'"""
+
+    if code is None:
+        return ''
+    return f"{code // 2 + 1}{'B' if code % 2 else 'A'}"
+
+
+def compatible_codes(code):
+    """Returns the Camelot codes that mix harmonically with `code`: the same
+    key, one step either way around the wheel, and the relative major/minor"""
+
+    number, letter = divmod(code, 2)
+    return sorted({code,
+                   ((number + 1) % 12) * 2 + letter,
+                   ((number - 1) % 12) * 2 + letter,
+                   number * 2 + (1 - letter)})
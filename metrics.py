@@ -0,0 +1,154 @@
+"""Prometheus metrics for the app, served on /metrics.
+
+Under gunicorn every worker is a separate process, so metrics are written to
+files in PROMETHEUS_MULTIPROC_DIR (set up by gunicorn.conf.py) and /metrics
+aggregates them across workers. Without that variable, e.g. under
+`flask run`, the metrics of the single process are served.
+
+/metrics is only served to scrapers that send METRICS_TOKEN as a bearer
+token."""
+
+import hmac
+import os
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from flask import g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge,
+                               Histogram, REGISTRY, generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+# bearer token a scraper must send to read /metrics; unset turns every scraper away
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+REQUEST_LATENCY = Histogram(
+    'crate_digger_request_duration_seconds', 'Time spent handling a request',
+    ['route', 'method'])
+REQUESTS = Counter(
+    'crate_digger_requests_total', 'Requests handled, by response status',
+    ['route', 'method', 'status'])
+
+SPOTIFY_LATENCY = Histogram(
+    'crate_digger_spotify_request_duration_seconds', 'Time spent on one Spotify API call, retries included',
+    ['endpoint'])
+SPOTIFY_REQUESTS = Counter(
+    'crate_digger_spotify_requests_total', "Spotify API calls, by final status ('error' if no response)",
+    ['endpoint', 'status'])
+
+SEED_PHASE_LATENCY = Histogram(
+    'crate_digger_seed_phase_duration_seconds', 'Time spent in each phase of a music search',
+    ['phase'])
+
+CACHE_REQUESTS = Counter(
+    'crate_digger_cache_requests_total', 'Cache lookups, by hit or miss',
+    ['cache', 'result'])
+
+DB_POOL_CHECKED_OUT = Gauge(
+    'crate_digger_db_pool_checked_out', 'Database connections in use',
+    multiprocess_mode='livesum')
+DB_POOL_OPEN = Gauge(
+    'crate_digger_db_pool_open', 'Database connections open',
+    multiprocess_mode='livesum')
+
+
+def spotify_endpoint(url):
+    """Returns the path of a Spotify API url, without the API version, for use
+    as a metric label, e.g. '/recommendations'"""
+
+    path = urlsplit(url).path
+    return path[3:] if path.startswith('/v1/') else path
+
+
+@contextmanager
+def observe_spotify(url):
+    """Times a Spotify API call made inside the block. The block should store
+    the final response's status code in the yielded dict's 'status'"""
+
+    endpoint = spotify_endpoint(url)
+    call = {'status': 'error'}
+    started = time.perf_counter()
+    try:
+        yield call
+    finally:
+        SPOTIFY_LATENCY.labels(endpoint).observe(time.perf_counter() - started)
+        SPOTIFY_REQUESTS.labels(endpoint, str(call['status'])).inc()
+
+
+@contextmanager
+def seed_phase(phase):
+    """Times one phase of a music search"""
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        SEED_PHASE_LATENCY.labels(phase).observe(time.perf_counter() - started)
+
+
+def cache_lookup(cache, hit):
+    """Counts a hit or miss on the named cache"""
+
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+@event.listens_for(Pool, 'connect')
+def _pool_connect(dbapi_connection, connection_record):
+    DB_POOL_OPEN.inc()
+
+
+@event.listens_for(Pool, 'close')
+def _pool_close(dbapi_connection, connection_record):
+    DB_POOL_OPEN.dec()
+
+
+@event.listens_for(Pool, 'checkout')
+def _pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_CHECKED_OUT.inc()
+
+
+@event.listens_for(Pool, 'checkin')
+def _pool_checkin(dbapi_connection, connection_record):
+    DB_POOL_CHECKED_OUT.dec()
+
+
+def init_metrics(app):
+    """Records the latency and status of every request, labelled by the route
+    rule (e.g. /playlists/<int:playlist_id>) rather than the raw path"""
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('request_started', None)
+        if started is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.labels(route, request.method).observe(time.perf_counter() - started)
+        REQUESTS.labels(route, request.method, str(response.status_code)).inc()
+        return response
+
+
+def metrics_authorized(authorization):
+    """Returns whether an Authorization header carries METRICS_TOKEN"""
+
+    if not METRICS_TOKEN or not authorization:
+        return False
+    return hmac.compare_digest(authorization.encode(), f'Bearer {METRICS_TOKEN}'.encode())
+
+
+def render_metrics():
+    """Returns (body, content type) of the metrics page, aggregated over
+    every worker when running in multiprocess mode"""
+
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
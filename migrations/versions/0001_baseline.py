@@ -0,0 +1,65 @@
+"""baseline schema
+
+Revision ID: 0001
+Revises: 
+Create Date: 2026-10-18 09:00:00.000000
+
+Databases created by the old db.create_all() already have these tables, so
+only the missing ones are created and such a database upgrades in place.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+    if 'users' not in existing:
+        op.create_table('users',
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('email', sa.Text(), nullable=False),
+                        sa.Column('username', sa.Text(), nullable=False),
+                        sa.Column('password', sa.Text(), nullable=False),
+                        sa.PrimaryKeyConstraint('id'),
+                        sa.UniqueConstraint('email'),
+                        sa.UniqueConstraint('username'))
+    if 'songs' not in existing:
+        op.create_table('songs',
+                        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+                        sa.Column('song_name', sa.String(), nullable=False),
+                        sa.Column('song_seed', sa.String(), nullable=False),
+                        sa.Column('artist_name', sa.String(), nullable=False),
+                        sa.Column('artist_seed', sa.String(), nullable=False),
+                        sa.Column('bpm', sa.Integer(), nullable=True),
+                        sa.Column('key', sa.String(), nullable=True),
+                        sa.PrimaryKeyConstraint('id'),
+                        sa.UniqueConstraint('song_seed'))
+    if 'playlists' not in existing:
+        op.create_table('playlists',
+                        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+                        sa.Column('name', sa.String(length=50), nullable=False),
+                        sa.Column('description', sa.String(length=100), nullable=True),
+                        sa.Column('user_id', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+                        sa.PrimaryKeyConstraint('id'))
+    if 'playlists_songs' not in existing:
+        op.create_table('playlists_songs',
+                        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+                        sa.Column('playlist_id', sa.Integer(), nullable=True),
+                        sa.Column('song_id', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['playlist_id'], ['playlists.id'], ondelete='CASCADE'),
+                        sa.ForeignKeyConstraint(['song_id'], ['songs.id'], ondelete='CASCADE'),
+                        sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('playlists_songs')
+    op.drop_table('playlists')
+    op.drop_table('songs')
+    op.drop_table('users')
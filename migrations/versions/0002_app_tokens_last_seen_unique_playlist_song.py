@@ -0,0 +1,44 @@
+"""app tokens, songs.last_seen and unique playlist songs
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('app_tokens',
+                    sa.Column('name', sa.String(), nullable=False),
+                    sa.Column('access_token', sa.Text(), nullable=False),
+                    sa.Column('expires_at', sa.Float(), nullable=False),
+                    sa.PrimaryKeyConstraint('name'))
+
+    with op.batch_alter_table('songs') as batch_op:
+        batch_op.add_column(sa.Column('last_seen', sa.DateTime(), nullable=True))
+
+    # the old add-to-playlist route could insert the same song twice
+    op.execute('DELETE FROM playlists_songs WHERE id NOT IN '
+               '(SELECT MIN(id) FROM playlists_songs GROUP BY playlist_id, song_id)')
+    with op.batch_alter_table('playlists_songs') as batch_op:
+        batch_op.create_unique_constraint(
+            'uq_playlist_song', ['playlist_id', 'song_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('playlists_songs') as batch_op:
+        batch_op.drop_constraint('uq_playlist_song', type_='unique')
+
+    with op.batch_alter_table('songs') as batch_op:
+        batch_op.drop_column('last_seen')
+
+    op.drop_table('app_tokens')
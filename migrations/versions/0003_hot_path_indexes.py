@@ -0,0 +1,39 @@
+"""indexes for the hot query paths
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 09:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a user's playlists, listed in id order (/playlists, /results, /lost-n-found)
+    op.create_index('ix_playlists_user_id_id', 'playlists', ['user_id', 'id'])
+    # song -> playlists lookups and the orphan sweeper's NOT EXISTS; playlist ->
+    # songs lookups are covered by uq_playlist_song (playlist_id, song_id)
+    op.create_index('ix_playlists_songs_song_id', 'playlists_songs', ['song_id'])
+    # keyset pagination of Lost n' Found by bpm and by key
+    op.create_index('ix_songs_bpm_id', 'songs', ['bpm', 'id'])
+    op.create_index('ix_songs_key_id', 'songs', ['key', 'id'])
+    op.create_index('ix_songs_artist_seed', 'songs', ['artist_seed'])
+    # the sweeper's grace period filter
+    op.create_index('ix_songs_last_seen', 'songs', ['last_seen'])
+
+
+def downgrade():
+    op.drop_index('ix_songs_last_seen', table_name='songs')
+    op.drop_index('ix_songs_artist_seed', table_name='songs')
+    op.drop_index('ix_songs_key_id', table_name='songs')
+    op.drop_index('ix_songs_bpm_id', table_name='songs')
+    op.drop_index('ix_playlists_songs_song_id', table_name='playlists_songs')
+    op.drop_index('ix_playlists_user_id_id', table_name='playlists')
@@ -0,0 +1,60 @@
+"""integer song key and mode with a Camelot code
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 09:20:00.000000
+
+Existing songs only stored the key's display name, so their mode and Camelot
+code stay empty until the song is returned by a search again.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+KEY_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+
+def upgrade():
+    op.drop_index('ix_songs_key_id', table_name='songs')
+
+    with op.batch_alter_table('songs') as batch_op:
+        batch_op.add_column(sa.Column('key_number', sa.SmallInteger(), nullable=True))
+        batch_op.add_column(sa.Column('mode', sa.SmallInteger(), nullable=True))
+        batch_op.add_column(sa.Column('camelot', sa.SmallInteger(), nullable=True))
+
+    cases = ' '.join(f"WHEN '{name}' THEN {number}"
+                     for number, name in enumerate(KEY_NAMES))
+    op.execute(f'UPDATE songs SET key_number = CASE key {cases} END')
+
+    with op.batch_alter_table('songs') as batch_op:
+        batch_op.drop_column('key')
+        batch_op.alter_column('key_number', new_column_name='key')
+
+    op.create_index('ix_songs_camelot_id', 'songs', ['camelot', 'id'])
+    op.create_index('ix_songs_camelot_bpm', 'songs', ['camelot', 'bpm'])
+
+
+def downgrade():
+    op.drop_index('ix_songs_camelot_bpm', table_name='songs')
+    op.drop_index('ix_songs_camelot_id', table_name='songs')
+
+    with op.batch_alter_table('songs') as batch_op:
+        batch_op.add_column(sa.Column('key_name', sa.String(), nullable=True))
+
+    cases = ' '.join(f"WHEN {number} THEN '{name}'"
+                     for number, name in enumerate(KEY_NAMES))
+    op.execute(f'UPDATE songs SET key_name = CASE key {cases} END')
+
+    with op.batch_alter_table('songs') as batch_op:
+        batch_op.drop_column('key')
+        batch_op.drop_column('mode')
+        batch_op.drop_column('camelot')
+        batch_op.alter_column('key_name', new_column_name='key')
+
+    op.create_index('ix_songs_key_id', 'songs', ['key', 'id'])
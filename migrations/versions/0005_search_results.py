@@ -0,0 +1,32 @@
+"""server side search results
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('search_results',
+                    sa.Column('id', sa.String(length=16), nullable=False),
+                    sa.Column('user_id', sa.Integer(), nullable=True),
+                    sa.Column('track_ids', sa.Text(), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_search_results_created_at', 'search_results', ['created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_search_results_created_at', table_name='search_results')
+    op.drop_table('search_results')
@@ -1,15 +1,38 @@
+from datetime import datetime
+import secrets
+
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
+from flask_migrate import Migrate
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
+
+from harmonic import camelot_code, camelot_label, compatible_codes, key_name
+from passwords import check_password, hash_password, needs_rehash
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
+migrate = Migrate()
+
+
+def dialect_insert():
+    """Returns the insert() construct for the current database, which supports
+    ON CONFLICT clauses on PostgreSQL and SQLite"""
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert
+    if dialect == 'sqlite':
+        return sqlite.insert
+    raise NotImplementedError(f'ON CONFLICT inserts are not supported on {dialect}')
 
 
 def connect_db(app):
+    """Connects the database to the app. The schema itself is managed by the
+    migrations in migrations/versions, applied with `flask db upgrade`"""
+
     with app.app_context():
         db.app = app
         db.init_app(app)
-        db.create_all()
+        migrate.init_app(app, db)
 
 
 class User(db.Model):
@@ -46,7 +69,7 @@ class User(db.Model):
     def signup(cls, username, email, password):
         """Sign up user. Hashes password and adds user to database"""
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(username=username, email=email, password=hashed_pwd)
 
@@ -55,12 +78,16 @@ class User(db.Model):
 
     @classmethod
     def authenticate(cls, username, password):
+        """Returns the user if the password matches. A password hashed at an
+        older bcrypt cost is rehashed at the current one; the caller commits"""
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = check_password(user.password, password)
             if is_auth:
+                if needs_rehash(user.password):
+                    user.password = hash_password(password)
                 return user
 
         return False
@@ -70,6 +97,9 @@ class Playlist(db.Model):
     "Playlist."
 
     __tablename__ = 'playlists'
+    __table_args__ = (
+        db.Index('ix_playlists_user_id_id', 'user_id', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(50), nullable=False)
@@ -80,17 +110,30 @@ class Playlist(db.Model):
                             cascade='all, delete', backref='playlists')
 
     @classmethod
-    def count_songs(cls, id):
+    def with_song_counts(cls, user_id):
+        """Returns a user's playlists as (playlist, song count) tuples, counted
+        in a single grouped query"""
+
+        return cls.song_counts_query(user_id).all()
 
-        playlist = PlaylistSong.query.filter(
-            PlaylistSong.playlist_id == id).count()
-        return playlist
+    @classmethod
+    def song_counts_query(cls, user_id):
+        return db.session.query(cls, db.func.count(PlaylistSong.id)).outerjoin(
+            PlaylistSong, PlaylistSong.playlist_id == cls.id).filter(
+            cls.user_id == user_id).group_by(cls.id).order_by(cls.id)
 
 
 class Song(db.Model):
     """Song"""
 
     __tablename__ = 'songs'
+    __table_args__ = (
+        db.Index('ix_songs_bpm_id', 'bpm', 'id'),
+        db.Index('ix_songs_camelot_id', 'camelot', 'id'),
+        db.Index('ix_songs_camelot_bpm', 'camelot', 'bpm'),
+        db.Index('ix_songs_artist_seed', 'artist_seed'),
+        db.Index('ix_songs_last_seen', 'last_seen'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     song_name = db.Column(db.String, nullable=False)
@@ -98,16 +141,224 @@ class Song(db.Model):
     artist_name = db.Column(db.String, nullable=False)
     artist_seed = db.Column(db.String, nullable=False)
     bpm = db.Column(db.Integer)
-    key = db.Column(db.String)
+    # Spotify's pitch class (0 = C ... 11 = B) and mode (1 = major, 0 = minor),
+    # and the Camelot wheel code derived from them, see harmonic.py
+    key = db.Column(db.SmallInteger)
+    mode = db.Column(db.SmallInteger)
+    camelot = db.Column(db.SmallInteger)
+    # last time the song was returned by a search, used to garbage collect
+    # songs that never made it onto a playlist
+    last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # page() sort names and the columns they order by
+    SORT_COLUMNS = {'bpm': 'bpm', 'key': 'camelot'}
+
+    @property
+    def key_name(self):
+        return key_name(self.key, self.mode)
+
+    @property
+    def camelot_label(self):
+        return camelot_label(self.camelot)
+
+    @classmethod
+    def harmonic_matches(cls, song, bpm_range=6, half_double=True, limit=50):
+        """Returns songs that mix with `song`: a compatible Camelot key and a
+        bpm within `bpm_range` of its bpm, or of half/double its bpm when
+        `half_double` is set. Each bpm window is a range scan on the
+        (camelot, bpm) index."""
+
+        if song.camelot is None or song.bpm is None:
+            return []
+        return cls.harmonic_matches_query(song, bpm_range, half_double).limit(limit).all()
+
+    @classmethod
+    def harmonic_matches_query(cls, song, bpm_range=6, half_double=True):
+        tempos = [song.bpm]
+        if half_double:
+            tempos += [song.bpm / 2, song.bpm * 2]
+
+        # overlapping windows are merged so no song is returned twice
+        windows = []
+        for low, high in sorted((round(tempo - bpm_range), round(tempo + bpm_range))
+                                for tempo in tempos):
+            if windows and low <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(high, windows[-1][1]))
+            else:
+                windows.append((low, high))
+
+        # one branch per window, so each is a camelot IN + bpm range scan on
+        # the (camelot, bpm) index; an OR of the windows leaves the planner
+        # free to scan by camelot alone and filter the tempo afterwards
+        codes = compatible_codes(song.camelot)
+        branches = [cls.query.filter(cls.camelot.in_(codes), cls.bpm.between(low, high),
+                                     cls.id != song.id)
+                    for low, high in windows]
+        query = branches[0].union_all(*branches[1:]) if len(branches) > 1 else branches[0]
+        return query.order_by(db.func.abs(cls.bpm - song.bpm), cls.id)
+
+    @classmethod
+    def page(cls, sort=None, after=None, limit=50, user_id=None):
+        """Returns a page of songs and the cursor for the next page (None on
+        the last page), using keyset pagination so every page costs the same
+        no matter how deep it is.
+
+        Songs are ordered newest first, or by `sort` ('bpm', or 'key' for
+        Camelot wheel order) with the id as a tiebreaker and songs missing that value last. Each song's
+        playlists are loaded in one extra query, limited to the playlists
+        belonging to `user_id`."""
+
+        songs = cls.page_query(sort, after, user_id).limit(limit + 1).all()
+
+        # songs without a bpm/key are paged separately, after all the others
+        if sort in cls.SORT_COLUMNS and len(songs) <= limit and not (after and after[0] is None):
+            songs += cls.page_query(sort, (None, 0), user_id).limit(
+                limit + 1 - len(songs)).all()
+
+        if len(songs) <= limit:
+            return songs, None
+
+        songs = songs[:limit]
+        last = songs[-1]
+        return songs, (getattr(last, cls.SORT_COLUMNS[sort]) if sort in cls.SORT_COLUMNS else None, last.id)
+
+    @classmethod
+    def page_query(cls, sort=None, after=None, user_id=None):
+        """Builds the query for the page of songs following the `after`
+        cursor. For the bpm and key orderings, a cursor with a value of None
+        pages through the songs that are missing that value."""
+
+        query = cls.query.options(selectinload(
+            cls.playlists.and_(Playlist.user_id == user_id)))
+
+        if sort in cls.SORT_COLUMNS:
+            column = getattr(cls, cls.SORT_COLUMNS[sort])
+            if after and after[0] is None:
+                return query.filter(column.is_(None), cls.id > after[1]).order_by(cls.id.asc())
+
+            query = query.filter(column.isnot(None)).order_by(
+                column.asc(), cls.id.asc())
+            if after:
+                query = query.filter(db.tuple_(column, cls.id) > after)
+        else:
+            query = query.order_by(cls.id.desc())
+            if after:
+                query = query.filter(cls.id < after[1])
+
+        return query
+
+    @classmethod
+    def bulk_upsert(cls, songs):
+        """Inserts a batch of songs with a single INSERT ... ON CONFLICT statement,
+        updating rows whose song_seed already exists. Takes a list of dicts of
+        column values and returns a dict of {song_seed: id}"""
+
+        # a statement can't touch the same row twice, so keep the last of any duplicates
+        now = datetime.utcnow()
+        rows = list({song['song_seed']: {**song,
+                                         'camelot': camelot_code(song.get('key'), song.get('mode')),
+                                         'last_seen': now}
+                     for song in songs}.values())
+        if not rows:
+            return {}
+
+        stmt = dialect_insert()(cls).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.song_seed],
+            set_={column: stmt.excluded[column]
+                  for column in rows[0] if column != 'song_seed'}
+        ).returning(cls.song_seed, cls.id)
+
+        ids = dict(db.session.execute(stmt).all())
+        db.session.commit()
+        return ids
+
+    @classmethod
+    def touch(cls, song_seeds):
+        """Marks songs as seen now with a single UPDATE, so the sweeper keeps
+        songs that are still being recommended from the cache. Committed with
+        the session's next commit."""
+
+        if song_seeds:
+            db.session.execute(db.update(cls).where(cls.song_seed.in_(song_seeds))
+                               .values(last_seen=datetime.utcnow()))
 
 
 class PlaylistSong(db.Model):
     """Mapping of a playlist to a song."""
 
     __tablename__ = 'playlists_songs'
+    __table_args__ = (
+        db.UniqueConstraint('playlist_id', 'song_id', name='uq_playlist_song'),
+        db.Index('ix_playlists_songs_song_id', 'song_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     playlist_id = db.Column(db.Integer, db.ForeignKey(
         'playlists.id', ondelete='CASCADE'))
     song_id = db.Column(db.Integer, db.ForeignKey(
         'songs.id', ondelete='CASCADE'))
+
+    @classmethod
+    def bulk_add(cls, playlist_id, song_ids):
+        """Adds songs to a playlist with a single INSERT ... SELECT statement.
+        Songs already on the playlist or missing from the songs table are
+        skipped. Returns the number of songs added"""
+
+        songs = db.select(db.literal(playlist_id), Song.id).where(
+            Song.id.in_(song_ids))
+        stmt = dialect_insert()(cls).from_select(
+            ['playlist_id', 'song_id'], songs).on_conflict_do_nothing()
+
+        added = db.session.execute(stmt).rowcount
+        db.session.commit()
+        return added
+
+
+class SearchResult(db.Model):
+    """Tracks returned by one music search, kept server side so the session
+    cookie only carries the search's id and results can be revisited or shared."""
+
+    __tablename__ = 'search_results'
+    __table_args__ = (
+        db.Index('ix_search_results_created_at', 'created_at'),
+    )
+
+    id = db.Column(db.String(16), primary_key=True,
+                   default=lambda: secrets.token_urlsafe(8))
+    user_id = db.Column(db.Integer, db.ForeignKey(
+        'users.id', ondelete='CASCADE'))
+    # comma separated Spotify track ids, in the order Spotify ranked them
+    track_ids = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def store(cls, track_ids, user_id=None):
+        """Saves a search's track ids and returns the new search id"""
+
+        result = cls(track_ids=','.join(track_ids), user_id=user_id)
+        db.session.add(result)
+        db.session.commit()
+        return result.id
+
+    def page(self, offset, limit):
+        """Returns `limit` of the search's songs from `offset` on, in the order
+        Spotify ranked them, and the offset of the next page (None on the
+        last page)"""
+
+        track_ids = [id for id in self.track_ids.split(',') if id]
+        end = offset + limit
+        rank = {track_id: i for i, track_id in enumerate(track_ids[offset:end])}
+        songs = Song.query.filter(Song.song_seed.in_(rank)).all() if rank else []
+        return (sorted(songs, key=lambda song: rank[song.song_seed]),
+                end if end < len(track_ids) else None)
+
+
+class AppToken(db.Model):
+    """Spotify access token shared by every worker of the app."""
+
+    __tablename__ = 'app_tokens'
+
+    name = db.Column(db.String, primary_key=True)
+    access_token = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.Float, nullable=False)
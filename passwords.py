@@ -0,0 +1,74 @@
+"""Password hashing with a configurable bcrypt cost. Hashes are computed on a
+small per-process thread pool, so a burst of logins waits its turn there
+instead of tying up every request thread (or, under gevent, the event loop)."""
+
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+# bcrypt work factor; each step doubles the time a hash takes. Passwords
+# hashed at another cost are rehashed at this one on their next login
+BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# hashes computed at once per worker process
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', 2))
+
+bcrypt = Bcrypt()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _reset_executor():
+    # the pool's threads don't survive a fork; the child starts its own
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_executor)
+
+
+def _gevent_patched():
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def hash_executor():
+    """Returns this process's hashing pool. Under gevent it uses native
+    threads, which monkey-patched threads are not, so a hash runs in parallel
+    with the event loop and the waiting greenlet yields"""
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if _gevent_patched():
+                from gevent.threadpool import ThreadPoolExecutor as Executor
+            else:
+                Executor = ThreadPoolExecutor
+            _executor = Executor(max_workers=HASH_WORKERS, thread_name_prefix='hash')
+        return _executor
+
+
+def hash_password(password, rounds=None):
+    """Returns a bcrypt hash of `password` at `rounds`, BCRYPT_LOG_ROUNDS by default"""
+
+    pw_hash = hash_executor().submit(
+        bcrypt.generate_password_hash, password, rounds or BCRYPT_LOG_ROUNDS).result()
+    return pw_hash.decode('UTF-8')
+
+
+def check_password(pw_hash, password):
+    return hash_executor().submit(bcrypt.check_password_hash, pw_hash, password).result()
+
+
+def hash_rounds(pw_hash):
+    """Returns the cost a bcrypt hash was computed at ('$2b$12$...' -> 12)"""
+
+    return int(pw_hash.split('$')[2])
+
+
+def needs_rehash(pw_hash, rounds=None):
+    return hash_rounds(pw_hash) != (rounds or BCRYPT_LOG_ROUNDS)
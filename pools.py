@@ -0,0 +1,41 @@
+import os
+
+# connections the database accepts from the web dyno in total, leaving room
+# for release commands, the sweeper and psql sessions
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', 20))
+# keep-alive connections to Spotify per worker process: at least enough for
+# one request's concurrent fan-out, at most HTTP_MAX_POOL_SIZE
+HTTP_MIN_POOL_SIZE = 10
+HTTP_MAX_POOL_SIZE = int(os.environ.get('HTTP_MAX_POOL_SIZE', 100))
+
+
+def pool_sizes(workers, concurrency, db_max_connections=DB_MAX_CONNECTIONS):
+    """Returns the database pool size, database pool overflow and Spotify
+    keep-alive pool size for one worker process that serves up to
+    `concurrency` requests at once (threads, or greenlets under gevent).
+
+    All `workers` together never open more than `db_max_connections`
+    database connections. Each worker keeps one connection of its share as
+    overflow for work outside the request's session (the shared token store,
+    the sweeper); requests beyond the pool wait up to DB_POOL_TIMEOUT for a
+    connection instead of exhausting the database. Spotify calls are
+    network waits, so every in-flight request may hold an HTTP connection."""
+
+    db_share = max(2, db_max_connections // max(1, workers))
+    db_pool_size = max(1, min(concurrency, db_share - 1))
+    http_pool_size = min(max(concurrency, HTTP_MIN_POOL_SIZE), HTTP_MAX_POOL_SIZE)
+    return db_pool_size, db_share - db_pool_size, http_pool_size
+
+
+def engine_options():
+    """Returns SQLALCHEMY_ENGINE_OPTIONS from DB_POOL_SIZE, DB_MAX_OVERFLOW and
+    DB_POOL_TIMEOUT, for whichever of them are set"""
+
+    options = {}
+    if os.environ.get('DB_POOL_SIZE'):
+        options['pool_size'] = int(os.environ['DB_POOL_SIZE'])
+    if os.environ.get('DB_MAX_OVERFLOW'):
+        options['max_overflow'] = int(os.environ['DB_MAX_OVERFLOW'])
+    if os.environ.get('DB_POOL_TIMEOUT'):
+        options['pool_timeout'] = float(os.environ['DB_POOL_TIMEOUT'])
+    return options
@@ -0,0 +1,132 @@
+import logging
+import os
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# add X-Query-Count and X-Query-Time headers to every response
+QUERY_STATS_HEADERS = os.environ.get('QUERY_STATS_HEADERS', '1') == '1'
+# a statement shape run this many times in one request is reported as a likely N+1
+QUERY_REPEAT_THRESHOLD = int(os.environ.get('QUERY_REPEAT_THRESHOLD', 5))
+
+logger = logging.getLogger(__name__)
+
+# every QueryStats collecting queries in the current context, outermost first
+_active_stats = ContextVar('query_stats', default=())
+
+# a run of bind parameters, e.g. the expanded values of an IN list
+_PARAMS = r'(?:\?|%\(\w+\)s|%s)'
+_PARAM_LIST = re.compile(rf'{_PARAMS}(?:\s*,\s*{_PARAMS})*')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Returns `statement` with whitespace collapsed and every run of bind
+    parameters replaced by a single ?, so one query repeated with different
+    values, or IN lists of different lengths, has one shape"""
+
+    return _PARAM_LIST.sub('?', _WHITESPACE.sub(' ', statement)).strip()
+
+
+class QueryStats:
+    """Queries run and time spent in the database during one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold=QUERY_REPEAT_THRESHOLD):
+        """Returns (shape, count) for statement shapes run at least
+        `threshold` times, most repeated first"""
+
+        return [(shape, count) for shape, count in self.shapes.most_common()
+                if count >= threshold]
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active_stats.get():
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    active = _active_stats.get()
+    if active and conn.info.get('query_started'):
+        seconds = time.perf_counter() - conn.info['query_started'].pop()
+        for stats in active:
+            stats.record(statement, seconds)
+
+
+@contextmanager
+def count_queries():
+    """Counts the queries run inside the block, including those of requests
+    made with the test client. Yields a QueryStats filled in as queries run."""
+
+    stats = QueryStats()
+    token = _active_stats.set(_active_stats.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _active_stats.reset(token)
+
+
+@contextmanager
+def query_budget(max_queries):
+    """Fails with an AssertionError if the block runs more than `max_queries`
+    queries, listing the statements that ran. For use in tests."""
+
+    with count_queries() as stats:
+        yield stats
+
+    if stats.count > max_queries:
+        shapes = '\n'.join(f'  {count} x {shape}' for shape, count in stats.shapes.most_common())
+        raise AssertionError(
+            f'{stats.count} queries ran, over the budget of {max_queries}:\n{shapes}')
+
+
+def init_query_stats(app):
+    """Counts the queries and database time of every request. The totals are
+    logged, and added to the response headers if QUERY_STATS_HEADERS is set.
+    Statement shapes repeated QUERY_REPEAT_THRESHOLD times are logged as
+    likely N+1 queries."""
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+        g.query_stats_token = _active_stats.set(_active_stats.get() + (g.query_stats,))
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.get('query_stats')
+        if stats is None:
+            return response
+
+        logger.info('%s %s ran %d queries in %.1fms', request.method, request.path,
+                    stats.count, stats.seconds * 1000)
+        for shape, count in stats.repeated():
+            logger.warning('%s %s ran the same query %d times, possible N+1: %s',
+                           request.method, request.path, count, shape)
+
+        if QUERY_STATS_HEADERS:
+            response.headers['X-Query-Count'] = str(stats.count)
+            response.headers['X-Query-Time'] = f'{stats.seconds * 1000:.1f}ms'
+        return response
+
+    @app.teardown_request
+    def stop_query_stats(exc):
+        token = g.pop('query_stats_token', None)
+        if token is not None:
+            _active_stats.reset(token)
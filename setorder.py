@@ -0,0 +1,163 @@
+import hashlib
+import os
+import time
+
+import numpy as np
+
+from cache import LRUCache
+
+# seconds allowed for improving an order once the greedy pass is done
+SET_ORDER_TIME_BUDGET = float(os.environ.get('SET_ORDER_TIME_BUDGET', 0.3))
+SET_ORDER_CACHE_SIZE = int(os.environ.get('SET_ORDER_CACHE_SIZE', 256))
+
+# cost of one step around the Camelot wheel, in bpm
+KEY_STEP_COST = 3.0
+# cost of a transition into or out of a track with an unknown key or bpm
+UNKNOWN_KEY_COST = 3 * KEY_STEP_COST
+UNKNOWN_BPM_COST = 10.0
+
+# maps (playlist id, playlist version) to the song ids in mix order
+set_order_cache = LRUCache(maxsize=SET_ORDER_CACHE_SIZE, name='set_order')
+
+
+def transition_cost(bpm, camelot, a, b):
+    """Returns the cost of mixing from tracks `a` into tracks `b` (arrays of
+    indexes into `bpm` and `camelot`, broadcast against each other).
+
+    The bpm part is the tempo jump, allowing for half/double time mixing. The
+    key part is the number of steps between the keys on the Camelot wheel,
+    counting a switch between relative major and minor as one step."""
+
+    bpm_a, bpm_b = bpm[a], bpm[b]
+    bpm_cost = np.minimum(np.abs(bpm_a - bpm_b),
+                          np.minimum(np.abs(bpm_a - 2 * bpm_b), np.abs(2 * bpm_a - bpm_b)))
+    bpm_cost = np.where(np.isnan(bpm_cost), UNKNOWN_BPM_COST, bpm_cost)
+
+    code_a, code_b = camelot[a], camelot[b]
+    wheel = np.abs(code_a // 2 - code_b // 2)
+    steps = np.minimum(wheel, 12 - wheel) + (code_a % 2 != code_b % 2)
+    key_cost = np.where((code_a < 0) | (code_b < 0),
+                        UNKNOWN_KEY_COST, steps * KEY_STEP_COST)
+
+    return bpm_cost + key_cost
+
+
+def greedy_order(bpm, camelot):
+    """Builds an order by starting from the slowest track and always mixing
+    into the cheapest track that hasn't been played yet.
+
+    Tracks with the same bpm and key are interchangeable, so the search runs
+    over the distinct (bpm, key) pairs rather than over every track."""
+
+    n = len(bpm)
+    filled = np.where(np.isnan(bpm), -1, bpm)
+    states, inverse = np.unique(np.stack([filled, camelot], axis=1),
+                                axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    state_bpm = np.where(states[:, 0] < 0, np.nan, states[:, 0])
+    state_camelot = states[:, 1].astype(int)
+
+    # tracks of each state, lowest index last so pop() plays them in order
+    members = [[] for _ in range(len(states))]
+    for track in range(n - 1, -1, -1):
+        members[inverse[track]].append(track)
+
+    start = int(np.nanargmin(bpm)) if not np.isnan(bpm).all() else 0
+    current = int(inverse[start])
+    members[current].remove(start)
+    order = [start]
+    active = np.array([state for state in range(len(states)) if members[state]])
+
+    while len(order) < n:
+        if not members[current]:
+            # the cheapest transition is always into a track with the same
+            # bpm and key, so only look elsewhere once those are used up
+            costs = transition_cost(state_bpm, state_camelot, current, active)
+            current = int(active[np.argmin(costs)])
+        order.append(members[current].pop())
+        if not members[current]:
+            active = active[active != current]
+
+    return np.array(order)
+
+
+def two_opt(order, bpm, camelot, deadline):
+    """Improves an order in place by reversing any stretch of it that makes the
+    set cheaper, until no reversal helps or `deadline` passes"""
+
+    n = len(order)
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(n - 2):
+            if time.monotonic() >= deadline:
+                break
+
+            # reversing order[i + 1:j + 1] replaces the transitions a -> b and
+            # c -> d with a -> c and b -> d
+            a, b = order[i], order[i + 1]
+            c = order[i + 2:]
+            d = order[i + 3:]
+            delta = transition_cost(bpm, camelot, a, c) - \
+                transition_cost(bpm, camelot, a, b)
+            delta[:-1] += transition_cost(bpm, camelot, b, d) - \
+                transition_cost(bpm, camelot, c[:-1], d)
+
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                j = i + 2 + best
+                order[i + 1:j + 1] = order[i + 1:j + 1][::-1].copy()
+                improved = True
+
+    return order
+
+
+def order_cost(order, bpm, camelot):
+    """Returns the total transition cost of playing tracks in `order`"""
+
+    return float(transition_cost(bpm, camelot, order[:-1], order[1:]).sum())
+
+
+def order_set(songs, time_budget=SET_ORDER_TIME_BUDGET):
+    """Returns `songs` reordered into a mixable set that keeps bpm jumps and
+    Camelot wheel distance between consecutive tracks low.
+
+    A greedy nearest-neighbour pass builds the order, then 2-opt reversals
+    improve it for up to `time_budget` seconds."""
+
+    if len(songs) < 3:
+        return sorted(songs, key=lambda song: (song.bpm is None, song.bpm or 0))
+
+    deadline = time.monotonic() + time_budget
+    bpm = np.array([np.nan if song.bpm is None else song.bpm for song in songs],
+                   dtype=float)
+    camelot = np.array([-1 if song.camelot is None else song.camelot for song in songs],
+                       dtype=int)
+
+    order = two_opt(greedy_order(bpm, camelot), bpm, camelot, deadline)
+    return [songs[i] for i in order]
+
+
+def playlist_version(songs):
+    """Returns a digest that changes whenever a playlist's songs, or their
+    tempo or key, change"""
+
+    digest = hashlib.sha1()
+    for song in sorted(songs, key=lambda song: song.id):
+        digest.update(f'{song.id}:{song.bpm}:{song.camelot};'.encode())
+    return digest.hexdigest()
+
+
+def cached_set_order(playlist_id, songs):
+    """Returns order_set(songs), reusing the order computed for the same
+    version of the playlist if there is one"""
+
+    cache_key = (playlist_id, playlist_version(songs))
+    song_ids = set_order_cache.get(cache_key)
+    if song_ids is None:
+        ordered = order_set(songs)
+        set_order_cache.set(cache_key, [song.id for song in ordered])
+        return ordered
+
+    by_id = {song.id: song for song in songs}
+    return [by_id[song_id] for song_id in song_ids]
@@ -56,3 +56,59 @@ async function getId(name, type) {
  })
  return resp
 }
+
+// TRACK ROW FUNCTIONS ---------------------
+// Rows show a track's details only; Spotify's player replaces a row's details
+// when it is played, and the previous player goes back to plain details
+
+let $playing = null
+
+$(document).on('click', '.play-track', function() {
+  const $embed = $(this).closest('.track-embed')
+
+  if ($playing) {
+    $playing.html($playing.data('details'))
+  }
+  $embed.data('details', $embed.html())
+  const track = encodeURIComponent($embed.data('track'))
+  $embed.html(`<iframe style="border-radius:12px" src="https://open.spotify.com/embed/track/${track}?utm_source=generator&theme=0" width="100%" height="152" frameBorder="0" allowfullscreen="" allow="autoplay; clipboard-write; encrypted-media; fullscreen; picture-in-picture"></iframe>`)
+  $playing = $embed
+})
+
+// Replaces a "More" placeholder with the next page of rows, which ends with
+// the placeholder for the page after it
+
+async function loadMoreRows(more) {
+  if (more.dataset.loading) {
+    return
+  }
+  more.dataset.loading = 'true'
+  try {
+    const resp = await axios.get(more.dataset.next)
+    $(more).replaceWith(resp.data)
+    observeMoreRows()
+  } catch (e) {
+    delete more.dataset.loading
+  }
+}
+
+const rowObserver = 'IntersectionObserver' in window ? new IntersectionObserver(entries => {
+  for (const entry of entries) {
+    if (entry.isIntersecting) {
+      rowObserver.unobserve(entry.target)
+      loadMoreRows(entry.target)
+    }
+  }
+}, {rootMargin: '400px'}) : null
+
+function observeMoreRows() {
+  if (rowObserver) {
+    $('.more-rows').each((i, more) => rowObserver.observe(more))
+  }
+}
+
+$(document).on('click', '.more-rows button', function() {
+  loadMoreRows(this.parentElement)
+})
+
+observeMoreRows()
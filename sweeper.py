@@ -0,0 +1,95 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from models import db, Song, PlaylistSong, SearchResult
+
+# songs that aren't on a playlist are kept in Lost n' Found for this long after they were last seen
+SWEEP_GRACE_PERIOD = int(os.environ.get('SONG_SWEEP_GRACE_PERIOD', 60 * 60 * 24))
+SWEEP_BATCH_SIZE = int(os.environ.get('SONG_SWEEP_BATCH_SIZE', 1000))
+# seconds between sweeps when running on a timer thread, 0 disables the thread
+SWEEP_INTERVAL = int(os.environ.get('SONG_SWEEP_INTERVAL', 0))
+# stored search results are deleted this long after the search, by default
+# when their songs may start to be swept
+SEARCH_RESULT_TTL = int(os.environ.get('SEARCH_RESULT_TTL', SWEEP_GRACE_PERIOD))
+
+logger = logging.getLogger(__name__)
+
+
+def sweep_orphan_songs(grace_period=SWEEP_GRACE_PERIOD, batch_size=SWEEP_BATCH_SIZE):
+    """Deletes songs that aren't on any playlist and haven't been seen in a
+    search for `grace_period` seconds. Rows are deleted in batches of
+    `batch_size`, each in its own transaction, so the sweep never holds long
+    locks on the songs table. Returns a dict of sweep metrics."""
+
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_period)
+    started = time.monotonic()
+    deleted = 0
+    batches = 0
+
+    while True:
+        orphans = orphan_songs_query(cutoff).limit(batch_size)
+        count = db.session.execute(
+            db.delete(Song).where(Song.id.in_(orphans)),
+            execution_options={'synchronize_session': False}).rowcount
+        db.session.commit()
+
+        deleted += count
+        batches += 1
+        if count < batch_size:
+            break
+
+    stats = {'deleted': deleted,
+             'batches': batches,
+             'seconds': round(time.monotonic() - started, 3)}
+    logger.info('Swept %(deleted)s orphaned songs in %(batches)s batches (%(seconds)ss)', stats)
+    return stats
+
+
+def orphan_songs_query(cutoff):
+    """Selects ids of songs on no playlist that were last seen before `cutoff`"""
+
+    return db.select(Song.id).where(
+        db.or_(Song.last_seen.is_(None), Song.last_seen < cutoff),
+        ~db.exists().where(PlaylistSong.song_id == Song.id))
+
+
+def sweep_search_results(ttl=SEARCH_RESULT_TTL):
+    """Deletes stored search results older than `ttl` seconds. Returns the
+    number of results deleted."""
+
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    deleted = db.session.execute(
+        db.delete(SearchResult).where(SearchResult.created_at < cutoff),
+        execution_options={'synchronize_session': False}).rowcount
+    db.session.commit()
+
+    logger.info('Swept %s stored search results', deleted)
+    return deleted
+
+
+def run_sweeps(app, interval, **options):
+    """Runs sweep_search_results and sweep_orphan_songs every `interval`
+    seconds, forever. A failed sweep is logged and retried on the next one."""
+
+    result_ttl = options.pop('result_ttl', SEARCH_RESULT_TTL)
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            try:
+                sweep_search_results(ttl=result_ttl)
+                sweep_orphan_songs(**options)
+            except Exception:
+                logger.exception('Song sweep failed')
+                db.session.rollback()
+
+
+def start_sweeper(app, interval=SWEEP_INTERVAL):
+    """Runs the sweeps every `interval` seconds on a daemon thread"""
+
+    thread = threading.Thread(target=run_sweeps, args=(app, interval),
+                              name='song-sweeper', daemon=True)
+    thread.start()
+    return thread
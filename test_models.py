@@ -1,11 +1,25 @@
 """User model tests"""
 from app import app
 from flask import session
-from models import db, User, Playlist, PlaylistSong, Song
-from utilities import get_id, get_genres
+from models import db, User, Playlist, PlaylistSong, Song, SearchResult
+from utilities import get_id, get_genres, fetch_genres, genre_cache, search, search_cache
+from cache import RevalidatingCache
+from tokens import token_manager, TokenManager, TokenError, request_token
+from sweeper import sweep_orphan_songs, sweep_search_results
+from explain import check_query_plans
+from features import get_audio_features, features_cache
+from client import SpotifyClient, partition_seeds, payload_key, recommendation_cache
+from querycount import query_budget
+from pools import pool_sizes
+from passwords import hash_rounds
+from datetime import datetime, timedelta
 from unittest import TestCase
 from unittest.mock import patch, Mock
+import gzip
 import os
+import re
+import threading
+import time
 # os.environ['DATABASE_URL'] = 'postgresql:///crate-digger-test'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///crate-digger-test'
 app.config['TESTING'] = True
@@ -13,6 +27,12 @@ app.config['WTF_CSRF_ENABLED'] = False
 db.create_all()
 
 
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
 class IntegrationTests(TestCase):
     """Test functionality of user model"""
 
@@ -71,18 +91,73 @@ class IntegrationTests(TestCase):
     def test_wrong_password(self):
         self.assertFalse(User.authenticate(self.u1.username, "wrongpass"))
 
+    def test_password_rehashed_at_new_cost(self):
+        """Tests that a login rehashes a password hashed at another cost"""
+
+        with patch('passwords.BCRYPT_LOG_ROUNDS', 4):
+            u = User.signup('rehash', 'rehash@test.com', 'test1234')
+            db.session.commit()
+        self.assertEqual(hash_rounds(u.password), 4)
+
+        with patch('passwords.BCRYPT_LOG_ROUNDS', 5):
+            self.assertFalse(User.authenticate('rehash', 'wrongpass'))
+            self.assertEqual(hash_rounds(u.password), 4)
+            u = User.authenticate('rehash', 'test1234')
+            db.session.commit()
+            self.assertEqual(hash_rounds(u.password), 5)
+            self.assertTrue(User.authenticate('rehash', 'test1234'))
+
 # ===============TESTS ACCESS TOKEN===============
-    def test_access_token(self):
-        """tests that a valid access token is retrieved from api"""
+    def test_token_error_page(self):
+        """Tests that a refused token request shows an error page instead of
+        redirecting back to the search form"""
+
+        refused = Mock(ok=False, status_code=400)
+        with patch('tokens.transport.post', return_value=refused):
+            self.assertRaises(TokenError, request_token)
 
         with self.client as c:
             with c.session_transaction() as sess:
                 sess['curr_user'] = self.uid1
-            resp = c.get('/auth', follow_redirects=True)
-            html = resp.get_data(as_text=True)
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn("token", session)
-            self.assertIn('1. Search for artists or songs to add', html)
+            for error in [TokenError('refused'), KeyError('genres')]:
+                with patch('app.get_genres', side_effect=error):
+                    resp = c.get('/seed')
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn('reach Spotify', resp.get_data(as_text=True))
+
+    def test_access_token(self):
+        """tests that /auth leaves the shared access token alone"""
+
+        manager = TokenManager(Mock(return_value=('abc', 3600)), refresh_margin=300)
+        manager.get_token()
+        with patch('app.token_manager', manager), \
+                patch('app.get_genres', return_value=['house']):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess['curr_user'] = self.uid1
+                resp = c.get('/auth', follow_redirects=True)
+                html = resp.get_data(as_text=True)
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn("token", session)
+                self.assertIn('1. Search for artists or songs to add', html)
+
+        self.assertEqual(manager.token, 'abc')
+        self.assertEqual(manager.fetch.call_count, 1)
+
+    def test_access_token_shared(self):
+        """tests that concurrent requests share a single token fetch"""
+
+        fetch = Mock(return_value=('abc', 3600))
+        manager = TokenManager(fetch, refresh_margin=300)
+        threads = [threading.Thread(target=manager.get_token)
+                   for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(manager.headers(), {'Authorization': 'Bearer abc'})
 
 # ===============TESTS FOR THE API===============
 
@@ -104,6 +179,123 @@ class IntegrationTests(TestCase):
             resp = get_id(track, type)
             self.assertIn("C'mon Girl", resp['tracks']['items'][0]['name'])
 
+    def test_search_trimmed_and_cached(self):
+        """Tests that searches only return the fields the UI needs, and that
+        repeated searches are answered from the cache"""
+
+        search_cache.clear()
+        spotify_resp = {'tracks': {'total': 1, 'href': 'https://api.spotify.com', 'items': [
+            {'id': '1BjQ4UMtFEevraJaLt0Ode', 'name': 'Reload', 'popularity': 58,
+             'album': {'name': 'Love Hope Faith', 'images': []},
+             'artists': [{'id': '0OpWIlokQeE7BNQMhuu2Nx', 'name': 'Colt Ford'}]}]}}
+
+        with patch('utilities.get_id', return_value=spotify_resp) as mock_get_id:
+            resp = search('Reload ', 'track')
+            search('reload', 'track')
+
+        self.assertEqual(mock_get_id.call_count, 1)
+        self.assertEqual(resp, {'input_type': 'track', 'tracks': {'total': 1, 'items': [
+            {'id': '1BjQ4UMtFEevraJaLt0Ode', 'name': 'Reload',
+             'artists': [{'name': 'Colt Ford'}]}]}})
+
+    def test_metrics(self):
+        """Tests that /metrics needs its token and reports routes, Spotify
+        calls and cache lookups"""
+
+        def sample(body, name, **labels):
+            series = name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+            line = re.search(rf'^{re.escape(series)} (\S+)$', body, re.M)
+            return float(line.group(1)) if line else 0
+
+        def scrape(c):
+            return c.get('/metrics', headers={'Authorization': 'Bearer scrape-me'}).get_data(as_text=True)
+
+        search_cache.clear()
+        session = Mock()
+        session.request.return_value = Mock(status_code=200, json=Mock(return_value={
+            'tracks': {'total': 0, 'items': []}}))
+
+        with patch('metrics.METRICS_TOKEN', 'scrape-me'), \
+                patch('utilities.token_manager.headers', return_value={'Authorization': 'Bearer x'}), \
+                patch('transport.get_session', return_value=session):
+            with self.client as c:
+                self.assertEqual(c.get('/metrics').status_code, 401)
+                self.assertEqual(c.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+
+                before = scrape(c)
+                c.get('/search?q=reload&type=track')
+                c.get('/search?q=reload&type=track')
+                after = scrape(c)
+
+        with patch('metrics.METRICS_TOKEN', None):
+            self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer None'}).status_code, 401)
+
+        for name, labels, delta in [
+                ('crate_digger_request_duration_seconds_count', {'route': '/search', 'method': 'GET'}, 2),
+                ('crate_digger_requests_total', {'route': '/search', 'method': 'GET', 'status': '200'}, 2),
+                ('crate_digger_spotify_requests_total', {'endpoint': '/search', 'status': '200'}, 1),
+                ('crate_digger_cache_requests_total', {'cache': 'search', 'result': 'miss'}, 1),
+                ('crate_digger_cache_requests_total', {'cache': 'search', 'result': 'hit'}, 1)]:
+            self.assertEqual(sample(after, name, **labels) - sample(before, name, **labels), delta,
+                             f'{name} {labels}')
+        self.assertIn('crate_digger_db_pool_checked_out', after)
+
+    def test_recommendation_payload_key(self):
+        """Tests that payloads asking for the same recommendations share a cache key"""
+
+        key = payload_key({'seed_tracks': 'a,b', 'seed_genres': 'house',
+                           'target_tempo': 120.0})
+        self.assertEqual(key, payload_key({'seed_genres': 'house', 'target_tempo': 120.04,
+                                           'seed_tracks': 'b,a'}))
+        self.assertNotEqual(key, payload_key({'seed_tracks': 'a,b', 'seed_genres': 'house',
+                                              'target_tempo': 124.0}))
+
+    def test_partition_seeds(self):
+        """Tests that seeds are split into requests of at most five, with the
+        genre in every request and repeated seeds counted once"""
+
+        tracks = [f't{i}' for i in range(20)]
+        self.assertEqual(partition_seeds({'seed_tracks': ','.join(tracks[:5])}),
+                         [{'seed_tracks': 't0,t1,t2,t3,t4'}])
+        self.assertEqual(partition_seeds({'seed_tracks': ','.join(tracks[:6])}),
+                         [{'seed_tracks': 't0,t1,t2,t3,t4'}, {'seed_tracks': 't5'}])
+        self.assertEqual(partition_seeds({'seed_genres': 'house', 'seed_tracks': ','.join(tracks[:6])}),
+                         [{'seed_genres': 'house', 'seed_tracks': 't0,t1,t2,t3'},
+                          {'seed_genres': 'house', 'seed_tracks': 't4,t5'}])
+
+        groups = partition_seeds({'seed_tracks': ','.join(tracks)})
+        self.assertEqual(len(groups), 4)
+        self.assertEqual(','.join(group['seed_tracks'] for group in groups), ','.join(tracks))
+
+        groups = partition_seeds({'seed_genres': 'house', 'seed_tracks': ','.join(tracks)})
+        self.assertEqual(len(groups), 5)
+        self.assertTrue(all(group['seed_genres'] == 'house' for group in groups))
+        self.assertEqual(','.join(group['seed_tracks'] for group in groups), ','.join(tracks))
+
+        self.assertEqual(partition_seeds({'seed_tracks': 'a,a,a,a,a,a'}), [{'seed_tracks': 'a'}])
+        self.assertEqual(partition_seeds({'seed_tracks': 'a,b,a,c,b,d,e'}),
+                         [{'seed_tracks': 'a,b,c,d,e'}])
+
+    def test_recommendations_fanout_ranks_by_votes(self):
+        """Tests that tracks recommended by more seed groups rank first, then
+        by their best rank within a group"""
+
+        responses = {'a': ['x', 'y', 'z'], 'b': ['z', 'w', 'y']}
+
+        def spotify_resp(url, params, headers):
+            self.assertNotIn('seed_artists', params)
+            self.assertEqual(params['target_tempo'], 120)
+            return Mock(json=Mock(return_value={'tracks': [
+                {'id': id} for id in responses[params['seed_tracks']]]}))
+
+        client = SpotifyClient({'seed_tracks': 'a', 'target_tempo': 120},
+                               headers={'Authorization': 'Bearer abc'})
+        with patch('client.transport.get', side_effect=spotify_resp) as get:
+            resp = client.get_recommendations_fanout([{'seed_tracks': 'a'}, {'seed_tracks': 'b'}])
+
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual([track['id'] for track in resp['tracks']], ['z', 'y', 'x', 'w'])
+
     def test_get_genres(self):
         """Tests our API for genre list retrieval"""
         with self.client as c:
@@ -112,6 +304,80 @@ class IntegrationTests(TestCase):
             self.assertIn("Ambient", str(resp))
             self.assertIn("Chill", str(resp))
 
+    def test_genre_cache_revalidates(self):
+        """Tests that the genre list is revalidated with its ETag, kept when
+        Spotify answers 304 and served stale when a refresh fails"""
+
+        cache = RevalidatingCache(ttl=60, refresh_ahead=10)
+        fetch = Mock(side_effect=[(['house'], 'v1'), (None, 'v1'), Exception('Spotify is down')])
+        self.assertEqual(cache.get(fetch), ['house'])
+
+        # inside the refresh-ahead window the list is revalidated in the background
+        cache.expires_at = time.monotonic() + 5
+        self.assertEqual(cache.get(fetch), ['house'])
+        wait_for(lambda: not cache._refreshing)
+        self.assertEqual(fetch.call_args_list[1].args, ('v1',))
+        self.assertGreater(cache.expires_at, time.monotonic() + 50)
+
+        cache.expires_at = 0
+        self.assertEqual(cache.get(fetch), ['house'])
+        self.assertEqual(fetch.call_count, 3)
+
+        with patch('utilities.transport.get', return_value=Mock(status_code=304)) as mock_get:
+            self.assertEqual(fetch_genres({'Authorization': 'Bearer x'}, 'v1'), (None, 'v1'))
+        self.assertEqual(mock_get.call_args.kwargs['headers']['If-None-Match'], 'v1')
+
+    def test_expired_cache_serves_stale_during_refresh(self):
+        """Tests that while one request refreshes an expired value, others get
+        the stale copy at once instead of waiting on the upstream"""
+
+        cache = RevalidatingCache(ttl=60, refresh_ahead=10)
+        cache.get(Mock(return_value=(['house'], 'v1')))
+        cache.expires_at = 0
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_fetch(etag):
+            started.set()
+            release.wait(5)
+            return ['house', 'techno'], 'v2'
+
+        refresher = threading.Thread(target=cache.get, args=(slow_fetch,))
+        refresher.start()
+        self.assertTrue(started.wait(5))
+
+        fetch = Mock()
+        began = time.monotonic()
+        self.assertEqual(cache.get(fetch), ['house'])
+        self.assertLess(time.monotonic() - began, 1)
+        fetch.assert_not_called()
+
+        release.set()
+        refresher.join()
+        self.assertEqual(cache.get(fetch), ['house', 'techno'])
+
+    def test_genre_background_refresh_has_app_context(self):
+        """Tests that a background genre refresh can reach the database, as
+        the shared token store does"""
+
+        def fetch(headers, etag):
+            # raises outside an app context
+            db.engine.pool.checkedout()
+            return [('', 'Genre (optional)'), ('house', 'House')], 'v2'
+
+        genre_cache.clear()
+        with patch('utilities.token_manager.headers', return_value={'Authorization': 'Bearer x'}), \
+                patch('utilities.fetch_genres', side_effect=fetch) as mock_fetch:
+            get_genres()
+            genre_cache.expires_at = time.monotonic() + genre_cache.refresh_ahead / 2
+            get_genres()
+            wait_for(lambda: not genre_cache._refreshing)
+
+        self.assertEqual(mock_fetch.call_count, 2)
+        self.assertGreater(genre_cache.expires_at, time.monotonic() + genre_cache.refresh_ahead)
+        genre_cache.clear()
+
 # ===============TESTS PLAYLISTS===============
 
     def test_create_playlist(self):
@@ -177,7 +443,7 @@ class IntegrationTests(TestCase):
                          artist_name='Artist',
                          artist_seed='3KKiTDneH2x2sLtVPnTSOh',
                          bpm='666666',
-                         key='F')
+                         key=5)
         test_song.id = 333
         db.session.add(playlist1)
         db.session.add(test_song)
@@ -202,6 +468,27 @@ class IntegrationTests(TestCase):
 
             self.assertIsNotNone(query)
 
+    def test_add_songs_to_playlist_skips_duplicates(self):
+        """Tests that adding songs already on a playlist doesn't duplicate them"""
+
+        playlist1 = Playlist(
+            name='test_list', description='test', user_id=self.uid1)
+        playlist1.id = 1234
+
+        for song_id, seed in [(333, 'seed333'), (444, 'seed444')]:
+            song = Song(song_name='test_song', song_seed=seed, artist_name='Artist',
+                        artist_seed='3KKiTDneH2x2sLtVPnTSOh', bpm=120, key=5)
+            song.id = song_id
+            db.session.add(song)
+        db.session.add(playlist1)
+        db.session.commit()
+
+        self.assertEqual(PlaylistSong.bulk_add(1234, [333]), 1)
+        # song 333 is already on the playlist and song 555 doesn't exist
+        self.assertEqual(PlaylistSong.bulk_add(1234, [333, 444, 555]), 1)
+        self.assertEqual(
+            PlaylistSong.query.filter_by(playlist_id=1234).count(), 2)
+
     def test_delete_song_from_playlist(self):
         """Tests that a song is successfully deleted from playlist"""
 
@@ -214,7 +501,7 @@ class IntegrationTests(TestCase):
                          artist_name='Artist',
                          artist_seed='3KKiTDneH2x2sLtVPnTSOh',
                          bpm='666666',
-                         key='F')
+                         key=5)
         test_song.id = 333
         db.session.add(playlist1)
         db.session.add(test_song)
@@ -238,8 +525,409 @@ class IntegrationTests(TestCase):
 
             self.assertIsNone(query)
 
+# ===============TESTS SONGS===============
+
+    def test_bulk_upsert_songs(self):
+        """Tests that songs are inserted in bulk and existing ones updated"""
+
+        ids = Song.bulk_upsert([
+            {'song_name': 'song1', 'song_seed': 'seed1', 'artist_name': 'Artist',
+             'artist_seed': 'artist1', 'bpm': 120, 'key': 0, 'mode': 1},
+            {'song_name': 'song2', 'song_seed': 'seed2', 'artist_name': 'Artist',
+             'artist_seed': 'artist1', 'bpm': 124, 'key': 2, 'mode': 0}])
+        self.assertEqual(set(ids), {'seed1', 'seed2'})
+
+        ids_again = Song.bulk_upsert([
+            {'song_name': 'song1', 'song_seed': 'seed1', 'artist_name': 'Artist',
+             'artist_seed': 'artist1', 'bpm': 128, 'key': 0, 'mode': 1}])
+
+        # existing song keeps its id and gets the new values
+        self.assertEqual(ids_again['seed1'], ids['seed1'])
+        self.assertEqual(Song.query.count(), 2)
+        self.assertEqual(Song.query.get(ids['seed1']).bpm, 128)
+        # C major is 8B on the Camelot wheel
+        self.assertEqual(Song.query.get(ids['seed1']).camelot_label, '8B')
+
+    def test_audio_features_batched(self):
+        """Tests that audio features are requested in batches of 100 ids and
+        that unknown tracks get placeholders"""
+
+        features_cache.clear()
+        track_ids = [f'track{i}' for i in range(150)] + ['unknown']
+
+        def spotify_resp(url, params, headers):
+            ids = params['ids'].split(',')
+            resp = Mock()
+            resp.json.return_value = {'audio_features': [
+                None if id == 'unknown' else {'id': id, 'tempo': 120.2, 'key': 5, 'mode': 1}
+                for id in ids]}
+            return resp
+
+        with patch('client.token_manager.headers', return_value={}), \
+                patch('client.transport.get', side_effect=spotify_resp) as mock_get:
+            features = get_audio_features(track_ids)
+
+        self.assertEqual(sorted(len(call.kwargs['params']['ids'].split(','))
+                                for call in mock_get.call_args_list), [51, 100])
+        self.assertEqual(len(features), 151)
+        self.assertEqual(features['track0'], [120, 5, 1])
+        self.assertEqual(features['unknown'], [None, None, None])
+
+    def test_audio_features_stored_songs(self):
+        """Tests that stored songs are answered from the songs table, only the
+        rest are requested from Spotify, and no token is fetched when every
+        track is stored"""
+
+        Song.bulk_upsert([{'song_name': name, 'song_seed': name, 'artist_name': 'Artist',
+                           'artist_seed': 'artist1', 'bpm': 128, 'key': 7, 'mode': 0}
+                          for name in ['stored1', 'stored2']] +
+                         [{'song_name': 'no_bpm', 'song_seed': 'no_bpm', 'artist_name': 'Artist',
+                           'artist_seed': 'artist1', 'bpm': None, 'key': None, 'mode': None}])
+        features_cache.clear()
+
+        def spotify_resp(url, params, headers):
+            resp = Mock()
+            resp.json.return_value = {'audio_features': [
+                {'id': id, 'tempo': 90, 'key': 2, 'mode': 1} for id in params['ids'].split(',')]}
+            return resp
+
+        with patch('client.token_manager.headers', return_value={}) as headers, \
+                patch('client.transport.get', side_effect=spotify_resp) as mock_get:
+            features = get_audio_features(['stored1', 'new', 'no_bpm', 'stored2'])
+            self.assertEqual(mock_get.call_args.kwargs['params']['ids'], 'new,no_bpm')
+            self.assertEqual(features, {'stored1': [128, 7, 0], 'stored2': [128, 7, 0],
+                                        'new': [90, 2, 1], 'no_bpm': [90, 2, 1]})
+
+            features_cache.clear()
+            self.assertEqual(get_audio_features(['stored1', 'stored2']),
+                             {'stored1': [128, 7, 0], 'stored2': [128, 7, 0]})
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(headers.call_count, 1)
+
+    def test_seed_releases_db_connection(self):
+        """Tests that /seed holds no database connection while waiting on Spotify"""
+
+        Song.bulk_upsert([{'song_name': 'stored', 'song_seed': 'stored', 'artist_name': 'Artist',
+                           'artist_seed': 'artist1', 'bpm': 120, 'key': 5, 'mode': 1}])
+        features_cache.clear()
+        recommendation_cache.clear()
+        db.session.close()
+        # audio features are fetched on worker threads without an app context
+        pool = db.engine.pool
+        checked_out = []
+
+        def spotify(method, url, **kwargs):
+            checked_out.append(pool.checkedout())
+            resp = Mock()
+            if 'recommendations' in url:
+                resp.json.return_value = {'tracks': [
+                    {'id': id, 'name': id, 'artists': [{'id': 'artist1', 'name': 'Artist'}]}
+                    for id in ['stored', 'new']]}
+            else:
+                resp.json.return_value = {'audio_features': [
+                    {'id': 'new', 'tempo': 99.6, 'key': 2, 'mode': 0}]}
+            return resp
+
+        with patch('client.token_manager.headers', return_value={'Authorization': 'Bearer x'}), \
+                patch('app.get_genres', return_value=['house']), \
+                patch('transport.request', side_effect=spotify):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess['curr_user'] = self.uid1
+                resp = c.post('/seed', data={'track': ['stored'], 'genre': 'house',
+                                             'key': '', 'mode': ''})
+
+        self.assertIn('/results/', resp.location)
+        self.assertEqual(checked_out, [0, 0])
+        self.assertEqual(Song.query.filter_by(song_seed='new').one().bpm, 100)
+
+    def test_seed_recommendations_cached(self):
+        """Tests that a repeated search skips both Spotify calls and keeps its
+        songs from being swept, and that a refresh asks Spotify again"""
+
+        features_cache.clear()
+        recommendation_cache.clear()
+        urls = []
+
+        def spotify(method, url, **kwargs):
+            urls.append(url.rsplit('/', 1)[-1])
+            resp = Mock()
+            if 'recommendations' in url:
+                resp.json.return_value = {'tracks': [
+                    {'id': 'rec', 'name': 'rec', 'artists': [{'id': 'artist1', 'name': 'Artist'}]}]}
+            else:
+                resp.json.return_value = {'audio_features': [
+                    {'id': 'rec', 'tempo': 120, 'key': 2, 'mode': 0}]}
+            return resp
+
+        data = {'track': ['seed'], 'genre': 'house', 'key': '', 'mode': ''}
+        with patch('client.token_manager.headers', return_value={'Authorization': 'Bearer x'}), \
+                patch('app.get_genres', return_value=['house']), \
+                patch('transport.request', side_effect=spotify):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess['curr_user'] = self.uid1
+                c.post('/seed', data=data)
+                self.assertEqual(urls, ['recommendations', 'audio-features'])
+
+                stale = datetime.utcnow() - timedelta(days=30)
+                db.session.execute(db.update(Song).values(last_seen=stale))
+                db.session.commit()
+                resp = c.post('/seed', data=data)
+                self.assertIn('/results/', resp.location)
+                self.assertEqual(len(urls), 2)
+                self.assertGreater(Song.query.filter_by(song_seed='rec').one().last_seen, stale)
+
+                c.post('/seed', data={**data, 'refresh': '1'})
+                self.assertEqual(urls[2:], ['recommendations'])
+
+    def test_harmonic_matches(self):
+        """Tests that compatible keys within the bpm range, including double
+        time, are matched and everything else is left out"""
+
+        ids = Song.bulk_upsert([
+            {'song_name': name, 'song_seed': name, 'artist_name': 'Artist',
+             'artist_seed': 'artist1', 'bpm': bpm, 'key': key, 'mode': mode}
+            for name, bpm, key, mode in [('a_minor', 124, 9, 0),
+                                         ('c_major', 126, 0, 1),
+                                         ('e_minor_double', 250, 4, 0),
+                                         ('d_minor_edge', 128, 2, 0),
+                                         ('d_minor_outside', 129, 2, 0),
+                                         ('b_minor', 124, 11, 0),
+                                         ('a_minor_slow', 100, 9, 0)]])
+
+        matches = Song.harmonic_matches(Song.query.get(ids['a_minor']), bpm_range=4)
+
+        # A minor is 8A: C major (8B), D minor (7A) and E minor (9A) mix with
+        # it, B minor (10A) is two steps away
+        self.assertEqual([song.song_seed for song in matches],
+                         ['c_major', 'd_minor_edge', 'e_minor_double'])
+
+    def test_sweep_orphan_songs(self):
+        """Tests that only old songs that aren't on a playlist are swept"""
+
+        playlist1 = Playlist(
+            name='test_list', description='test', user_id=self.uid1)
+        playlist1.id = 1234
+        db.session.add(playlist1)
+
+        old = datetime.utcnow() - timedelta(days=2)
+        for song_id, last_seen in [(1, old), (2, old), (3, datetime.utcnow())]:
+            song = Song(song_name='test_song', song_seed=f'seed{song_id}',
+                        artist_name='Artist', artist_seed='artist1',
+                        bpm=120, key=5, last_seen=last_seen)
+            song.id = song_id
+            db.session.add(song)
+        db.session.commit()
+        PlaylistSong.bulk_add(1234, [1])
+
+        stats = sweep_orphan_songs(grace_period=60 * 60, batch_size=1)
+
+        self.assertEqual(stats['deleted'], 1)
+        self.assertEqual(sorted(s.id for s in Song.query.all()), [1, 3])
+
+    def test_sweeper_process(self):
+        """Tests that `sweep-songs --every` keeps sweeping and outlives a
+        failed sweep"""
+
+        sweeps = Mock(side_effect=[{'deleted': 0, 'batches': 1, 'seconds': 0},
+                                   Exception('database went away'),
+                                   {'deleted': 0, 'batches': 1, 'seconds': 0}])
+        # the third sleep stops the loop
+        with patch('sweeper.time.sleep', side_effect=[None, None, KeyboardInterrupt]) as sleep, \
+                patch('app.sweep_orphan_songs', sweeps), patch('sweeper.sweep_orphan_songs', sweeps):
+            result = app.test_cli_runner().invoke(args=['sweep-songs', '--every', '3600'])
+
+        # click reports the interrupt as an abort
+        self.assertEqual(result.exit_code, 1)
+        self.assertEqual(sweeps.call_count, 3)
+        self.assertEqual([call.args for call in sleep.call_args_list], [(3600,)] * 3)
+
+    def test_search_results_stored(self):
+        """Tests that search results are served from the server side store
+        in rank order, and that old results are swept"""
+
+        Song.bulk_upsert([
+            {'song_name': f'song{i}', 'song_seed': f'seed{i}', 'artist_name': 'Artist',
+             'artist_seed': 'artist1', 'bpm': 120, 'key': 5, 'mode': 1}
+            for i in range(3)])
+        search_id = SearchResult.store(['seed2', 'seed0'], user_id=self.uid1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['curr_user'] = self.uid2
+            html = c.get(f'/results/{search_id}').get_data(as_text=True)
+
+        self.assertLess(html.index('song2'), html.index('song0'))
+        self.assertNotIn('song1', html)
+
+        self.assertEqual(sweep_search_results(ttl=60 * 60), 0)
+        SearchResult.query.update(
+            {'created_at': datetime.utcnow() - timedelta(days=2)})
+        db.session.commit()
+        self.assertEqual(sweep_search_results(ttl=60 * 60), 1)
+
+    def test_track_rows_follow_next(self):
+        """Tests that following data-next from a results or playlist page
+        returns every row once and in order, and that row fragments are only
+        served to the playlist's owner"""
+
+        def walk(c, url, pattern):
+            ids = []
+            while url:
+                html = c.get(url).get_data(as_text=True)
+                ids += [int(id) for id in re.findall(pattern, html)]
+                next_rows = re.search(r'data-next="([^"]+)"', html)
+                url = next_rows.group(1).replace('&amp;', '&') if next_rows else None
+            return ids
+
+        ids = Song.bulk_upsert([
+            {'song_name': f'song{i}', 'song_seed': f'seed{i}', 'artist_name': 'Artist',
+             'artist_seed': 'artist1', 'bpm': bpm, 'key': 5, 'mode': 1}
+            for i, bpm in enumerate([128, 90, 120, 90, 100, 140, 75])])
+        ranked = [f'seed{i}' for i in [3, 0, 6, 1, 5, 2, 4]]
+        search_id = SearchResult.store(ranked, user_id=self.uid1)
+
+        playlist = Playlist(name='rows', description='test', user_id=self.uid1)
+        db.session.add(playlist)
+        db.session.commit()
+        playlist_id = playlist.id
+        added = [f'seed{i}' for i in [5, 2, 0, 4, 6, 1, 3]]
+        for seed in added:
+            PlaylistSong.bulk_add(playlist_id, [ids[seed]])
+        by_bpm = sorted(added, key=lambda seed: (Song.query.get(ids[seed]).bpm, ids[seed]))
+
+        with patch('app.TRACK_PAGE_SIZE', 2), self.client as c:
+            with c.session_transaction() as sess:
+                sess['curr_user'] = self.uid1
+            self.assertEqual(walk(c, f'/results/{search_id}', r'id="song-(\d+)"'),
+                             [ids[seed] for seed in ranked])
+            song_ids = r'/delete/\d+/(\d+)'
+            self.assertEqual(walk(c, f'/playlists/{playlist_id}', song_ids),
+                             [ids[seed] for seed in added])
+            self.assertEqual(walk(c, f'/playlists/{playlist_id}/bpm', song_ids),
+                             [ids[seed] for seed in by_bpm])
+            self.assertEqual(sorted(walk(c, f'/playlists/{playlist_id}/mix', song_ids)),
+                             sorted(ids.values()))
+
+            with c.session_transaction() as sess:
+                sess['curr_user'] = self.uid2
+            self.assertEqual(c.get(f'/playlists/{playlist_id}/rows?offset=2').status_code, 403)
+
+            with c.session_transaction() as sess:
+                del sess['curr_user']
+            self.assertEqual(c.get(f'/playlists/{playlist_id}/rows?offset=2').status_code, 401)
+            self.assertEqual(c.get(f'/results/{search_id}/rows?offset=2').status_code, 401)
+
+    def test_route_queries_use_indexes(self):
+        """Tests that the main routes' queries are planned with their indexes"""
+
+        for description, passed, plan in check_query_plans():
+            self.assertTrue(passed, f'{description} is not using its index:\n{plan}')
+
+    def test_pool_sizes(self):
+        """Tests that worker pools share the database connection limit"""
+
+        self.assertEqual(pool_sizes(2, 1, db_max_connections=20), (1, 9, 10))
+        self.assertEqual(pool_sizes(4, 1000, db_max_connections=20), (4, 1, 100))
+        for workers in range(1, 11):
+            pool, overflow, _ = pool_sizes(workers, 1000, db_max_connections=20)
+            self.assertLessEqual(workers * (pool + overflow), 20)
+
+    def test_song_page_cursors(self):
+        """Tests that following next_cursor returns every song exactly once
+        and in order for each sort, including the songs missing a bpm or key
+        that are paged after the rest"""
+
+        Song.bulk_upsert([{'song_name': f'song{i}', 'song_seed': f'seed{i}', 'artist_name': 'Artist',
+                           'artist_seed': 'artist1', 'bpm': bpm, 'key': key, 'mode': 1 if key is not None else None}
+                          for i, (bpm, key) in enumerate([(120, 5), (None, 2), (90, None), (120, 0),
+                                                          (None, None), (90, 5), (128, 7), (None, 7),
+                                                          (120, None), (75, 2), (None, 0)])])
+        songs = Song.query.all()
+
+        def expected(sort):
+            if sort is None:
+                return [song.id for song in sorted(songs, key=lambda song: -song.id)]
+            column = Song.SORT_COLUMNS[sort]
+            present = [song for song in songs if getattr(song, column) is not None]
+            missing = [song for song in songs if getattr(song, column) is None]
+            return ([song.id for song in sorted(present, key=lambda song: (getattr(song, column), song.id))] +
+                    sorted(song.id for song in missing))
+
+        for sort in [None, 'bpm', 'key']:
+            for limit in range(1, len(songs) + 2):
+                seen = []
+                after = None
+                while True:
+                    page, after = Song.page(sort=sort, after=after, limit=limit)
+                    self.assertLessEqual(len(page), limit)
+                    seen += [song.id for song in page]
+                    if after is None:
+                        break
+                self.assertEqual(seen, expected(sort), f'sort={sort} limit={limit}')
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['curr_user'] = self.uid1
+            for sort in [None, 'bpm', 'key']:
+                url = f"/lost-n-found/rows?limit=2{f'&sort={sort}' if sort else ''}"
+                seen = []
+                while url:
+                    html = c.get(url).get_data(as_text=True)
+                    seen += [int(id) for id in re.findall(r'id="song-(\d+)"', html)]
+                    next_rows = re.search(r'data-next="([^"]+)"', html)
+                    url = next_rows.group(1).replace('&amp;', '&') if next_rows else None
+                self.assertEqual(seen, expected(sort), f'sort={sort}')
+
 # ===============TESTS FOR DIRECT/UNAUTHORIZED VIEWS===============
 
+    def test_route_query_budgets(self):
+        """Tests that the main routes run a fixed number of queries however
+        many songs and playlists there are"""
+
+        playlist1 = Playlist(
+            name='test_list', description='test', user_id=self.uid1)
+        playlist1.id = 1234
+        db.session.add(playlist1)
+        db.session.commit()
+        Song.bulk_upsert([
+            {'song_name': f'song{i}', 'song_seed': f'seed{i}', 'artist_name': 'Artist',
+             'artist_seed': 'artist1', 'bpm': 100 + i, 'key': i % 12, 'mode': 1}
+            for i in range(20)])
+        PlaylistSong.bulk_add(1234, [s.id for s in Song.query.all()])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['curr_user'] = self.uid1
+
+            for url, budget in [('/playlists', 2),
+                                ('/playlists/1234', 3),
+                                ('/playlists/1234/key', 3),
+                                ('/playlists/1234/mix', 3),
+                                ('/playlists/1234/rows?sort=bpm&offset=10', 3),
+                                ('/lost-n-found', 4),
+                                ('/lost-n-found/rows?limit=5', 3)]:
+                with query_budget(budget):
+                    resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+
+    def test_static_assets_fingerprinted(self):
+        """Tests that pages link fingerprinted assets served compressed and immutable"""
+
+        with self.client as c:
+            html = c.get('/login').get_data(as_text=True)
+            css = re.search(r'href="(/assets/style\.[0-9a-f]{12}\.css)"', html).group(1)
+
+            resp = c.get(css, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertIn('html, body', gzip.decompress(resp.data).decode())
+
+            resp = c.get(css, headers={'Accept-Encoding': ''})
+            self.assertNotIn('Content-Encoding', resp.headers)
+
     def test_get_homepage(self):
         """Tests unauthorized view for home page."""
         with self.client as c:
@@ -0,0 +1,55 @@
+"""Harmonic set ordering tests"""
+from setorder import order_set, cached_set_order, set_order_cache
+from types import SimpleNamespace
+from unittest import TestCase
+import random
+import time
+
+
+def make_songs(count, seed=1):
+    rng = random.Random(seed)
+    return [SimpleNamespace(id=i, bpm=rng.randint(80, 175), camelot=rng.randint(0, 23))
+            for i in range(count)]
+
+
+class SetOrderTests(TestCase):
+    """Test ordering playlists into mixable sets"""
+
+    def test_order_keeps_every_song(self):
+        songs = make_songs(50)
+        ordered = order_set(songs)
+
+        self.assertEqual(sorted(song.id for song in ordered), list(range(50)))
+
+    def test_order_groups_matching_tracks(self):
+        """Tracks with the same tempo and key should be played back to back"""
+
+        songs = [SimpleNamespace(id=1, bpm=120, camelot=14),
+                 SimpleNamespace(id=2, bpm=90, camelot=3),
+                 SimpleNamespace(id=3, bpm=120, camelot=14),
+                 SimpleNamespace(id=4, bpm=90, camelot=3),
+                 SimpleNamespace(id=5, bpm=None, camelot=None)]
+        ordered = [song.id for song in order_set(songs)]
+
+        self.assertEqual(ordered[:2], [2, 4])
+        self.assertEqual(abs(ordered.index(1) - ordered.index(3)), 1)
+
+    def test_large_playlist_within_budget(self):
+        songs = make_songs(5000)
+
+        start = time.monotonic()
+        order_set(songs, time_budget=0.3)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_order_cached_per_playlist_version(self):
+        set_order_cache.clear()
+        songs = make_songs(20)
+
+        first = cached_set_order(1, songs)
+        self.assertEqual(len(set_order_cache), 1)
+        self.assertEqual(cached_set_order(1, list(reversed(songs))), first)
+
+        # changing a song's tempo makes a new version of the playlist
+        songs[0].bpm += 1
+        cached_set_order(1, songs)
+        self.assertEqual(len(set_order_cache), 2)
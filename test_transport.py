@@ -0,0 +1,92 @@
+"""Spotify transport retry tests"""
+from prometheus_client import REGISTRY
+from unittest import TestCase
+from unittest.mock import patch, Mock
+import requests
+import transport
+
+URL = 'https://api.spotify.com/v1/recommendations'
+
+
+def response(status, headers=None):
+    return Mock(status_code=status, headers=headers or {})
+
+
+def spotify_calls(status):
+    return REGISTRY.get_sample_value('crate_digger_spotify_requests_total',
+                                     {'endpoint': '/recommendations', 'status': str(status)}) or 0
+
+
+class TransportTests(TestCase):
+    """Test retries of Spotify API calls"""
+
+    def send(self, *results):
+        """Sends a GET whose attempts return or raise `results` in turn.
+        Returns (response, session.request mock, time.sleep mock)"""
+
+        session = Mock()
+        session.request.side_effect = results
+        with patch('transport.get_session', return_value=session), \
+                patch('transport.time.sleep') as sleep, \
+                patch('transport.random.uniform', side_effect=lambda low, high: high):
+            return transport.get(URL), session.request, sleep
+
+    def test_success_not_retried(self):
+        before = spotify_calls(200)
+        resp, send, sleep = self.send(response(200))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(send.call_count, 1)
+        sleep.assert_not_called()
+        self.assertEqual(spotify_calls(200), before + 1)
+
+    def test_server_errors_retried_with_backoff(self):
+        before = spotify_calls(200)
+        resp, send, sleep = self.send(response(502), response(503), response(200))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list],
+                         [transport.HTTP_BACKOFF_BASE, transport.HTTP_BACKOFF_BASE * 2])
+        self.assertEqual(spotify_calls(200), before + 1)
+
+    def test_rate_limit_honors_retry_after(self):
+        resp, send, sleep = self.send(response(429, {'Retry-After': '2'}), response(200))
+
+        self.assertEqual(resp.status_code, 200)
+        sleep.assert_called_once_with(2.0)
+
+    def test_long_retry_after_returned_at_once(self):
+        """A Retry-After beyond HTTP_BACKOFF_MAX can't be waited out, so the
+        429 is returned instead of spending every attempt on it"""
+
+        before = spotify_calls(429)
+        retry_after = str(transport.HTTP_BACKOFF_MAX + 1)
+        resp, send, sleep = self.send(response(429, {'Retry-After': retry_after}), response(200))
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(send.call_count, 1)
+        sleep.assert_not_called()
+        self.assertEqual(spotify_calls(429), before + 1)
+
+    def test_connection_errors_retried(self):
+        resp, send, sleep = self.send(requests.ConnectionError(), requests.Timeout(), response(200))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_gives_up_after_last_attempt(self):
+        attempts = transport.HTTP_MAX_RETRIES + 1
+
+        before = spotify_calls(503)
+        resp, send, sleep = self.send(*[response(503)] * attempts)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(send.call_count, attempts)
+        self.assertEqual(sleep.call_count, attempts - 1)
+        self.assertEqual(spotify_calls(503), before + 1)
+
+        before = spotify_calls('error')
+        with self.assertRaises(requests.ConnectionError):
+            self.send(*[requests.ConnectionError()] * attempts)
+        self.assertEqual(spotify_calls('error'), before + 1)
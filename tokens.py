@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from access import CLIENT_ID, CLIENT_SECRET
+from models import db, AppToken
+from transport import SPOTIFY_ACCOUNTS_URL
+import transport
+
+# refresh the app token this many seconds before Spotify says it expires
+TOKEN_REFRESH_MARGIN = int(os.environ.get('SPOTIFY_TOKEN_REFRESH_MARGIN', 300))
+# 'memory' keeps one token per process, 'db' shares one token across the deployment
+TOKEN_STORE = os.environ.get('SPOTIFY_TOKEN_STORE', 'memory')
+
+logger = logging.getLogger(__name__)
+
+
+class TokenError(Exception):
+    """Spotify refused to issue an access token"""
+
+
+def request_token():
+    """Requests a client credentials token from Spotify. Returns a tuple of
+    the access token and its lifetime in seconds. Raises TokenError if
+    Spotify responds with an error, e.g. for bad client credentials"""
+
+    resp = transport.post(f'{SPOTIFY_ACCOUNTS_URL}/api/token',
+                          data={'grant_type': 'client_credentials',
+                                'client_id': CLIENT_ID,
+                                'client_secret': CLIENT_SECRET})
+    body = resp.json() if resp.ok else {}
+    if 'access_token' not in body:
+        raise TokenError(f'Spotify token request failed with HTTP {resp.status_code}')
+    return body['access_token'], body['expires_in']
+
+
+class DBTokenStore:
+    """Shares one app token between every worker of a deployment through the
+    app_tokens table. The row is locked while refreshing so only one worker
+    calls Spotify's token endpoint."""
+
+    def __init__(self, name='spotify'):
+        self.name = name
+
+    def refresh(self, fetch, margin):
+        """Returns a tuple of (token, expires_at) that is valid for at least
+        `margin` more seconds, fetching a new token only if the stored one isn't"""
+
+        try:
+            with db.engine.begin() as conn:
+                row = conn.execute(select(AppToken.access_token, AppToken.expires_at)
+                                   .where(AppToken.name == self.name)
+                                   .with_for_update()).first()
+                if row and row.expires_at > time.time() + margin:
+                    return row.access_token, row.expires_at
+
+                token, expires_in = fetch()
+                expires_at = time.time() + expires_in
+                if row:
+                    conn.execute(AppToken.__table__.update()
+                                 .where(AppToken.name == self.name)
+                                 .values(access_token=token, expires_at=expires_at))
+                else:
+                    conn.execute(AppToken.__table__.insert()
+                                 .values(name=self.name, access_token=token, expires_at=expires_at))
+        except IntegrityError:
+            # another worker stored the first token at the same time, use theirs
+            return self.refresh(fetch, margin)
+
+        return token, expires_at
+
+    def clear(self):
+        with db.engine.begin() as conn:
+            conn.execute(AppToken.__table__.delete()
+                         .where(AppToken.name == self.name))
+
+
+class TokenManager:
+    """Holds the app-wide Spotify access token and refreshes it before it
+    expires. Refreshes are single-flight: one thread fetches a new token while
+    the others keep using the current one for as long as it's still valid."""
+
+    def __init__(self, fetch, refresh_margin, store=None):
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.store = store
+        self.token = None
+        self.expires_at = 0
+        self._lock = threading.Lock()
+
+    def get_token(self):
+        now = time.time()
+        if self.token and now < self.expires_at - self.refresh_margin:
+            return self.token
+
+        still_valid = self.token is not None and now < self.expires_at
+        if not self._lock.acquire(blocking=not still_valid):
+            return self.token
+
+        try:
+            if not self.token or time.time() >= self.expires_at - self.refresh_margin:
+                self._refresh()
+        except Exception:
+            if not still_valid:
+                raise
+            logger.exception('Spotify token refresh failed, using current token')
+        finally:
+            self._lock.release()
+
+        return self.token
+
+    def headers(self):
+        """Returns authorization headers for a Spotify API request"""
+
+        return {'Authorization': 'Bearer ' + self.get_token()}
+
+    def invalidate(self):
+        """Discards the current token so the next request fetches a new one"""
+
+        with self._lock:
+            self.token = None
+            self.expires_at = 0
+            if self.store:
+                self.store.clear()
+
+    def _refresh(self):
+        if self.store:
+            token, expires_at = self.store.refresh(self.fetch, self.refresh_margin)
+        else:
+            token, expires_in = self.fetch()
+            expires_at = time.time() + expires_in
+        self.token, self.expires_at = token, expires_at
+
+
+token_manager = TokenManager(request_token,
+                             refresh_margin=TOKEN_REFRESH_MARGIN,
+                             store=DBTokenStore() if TOKEN_STORE == 'db' else None)
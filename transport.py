@@ -0,0 +1,103 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import observe_spotify
+
+SPOTIFY_API_URL = os.environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+SPOTIFY_ACCOUNTS_URL = os.environ.get(
+    'SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com')
+
+# connection pool and timeout settings for every call made to Spotify
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+HTTP_BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', 0.25))
+HTTP_BACKOFF_MAX = float(os.environ.get('HTTP_BACKOFF_MAX', 8))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Returns the keep-alive session for this worker process, creating it on
+    first use. A forked worker never reuses its parent's sockets."""
+
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                      pool_maxsize=HTTP_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+                _session_pid = os.getpid()
+    return _session
+
+
+def backoff_delay(attempt, resp=None):
+    """Seconds to wait before retry number `attempt`, or None if it isn't worth
+    retrying. Honors Spotify's Retry-After header on a 429, giving up when it
+    asks for longer than HTTP_BACKOFF_MAX; otherwise uses exponential backoff
+    with full jitter"""
+
+    if resp is not None and resp.status_code == 429:
+        try:
+            retry_after = float(resp.headers['Retry-After'])
+        except (KeyError, ValueError):
+            pass
+        else:
+            return retry_after if retry_after <= HTTP_BACKOFF_MAX else None
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+
+def request(method, url, **kwargs):
+    """Sends a request to Spotify over the pooled session, retrying on
+    connection errors, timeouts, 429s and 5xx responses"""
+
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    session = get_session()
+
+    with observe_spotify(url) as call:
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            try:
+                resp = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == HTTP_MAX_RETRIES:
+                    raise
+                resp = None
+            else:
+                if resp.status_code not in RETRY_STATUSES or attempt == HTTP_MAX_RETRIES:
+                    call['status'] = resp.status_code
+                    return resp
+
+            delay = backoff_delay(attempt, resp)
+            if delay is None:
+                # rate limited for longer than a request should wait
+                call['status'] = resp.status_code
+                return resp
+            logger.warning('Spotify %s %s failed (%s), retrying in %.2fs',
+                           method, url, resp.status_code if resp is not None else 'connection error', delay)
+            time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -1,32 +1,107 @@
-from flask import Flask, session
-from access import CLIENT_ID, CLIENT_SECRET
-import requests
+from flask import current_app
+from cache import RevalidatingCache, LRUCache, SingleFlight
+from tokens import token_manager
+from transport import SPOTIFY_API_URL
+import transport
+import os
+
+# the genre seed list rarely changes, so it is kept in memory for the life of the process
+GENRE_CACHE_TTL = int(os.environ.get('GENRE_CACHE_TTL', 60 * 60 * 24))
+GENRE_REFRESH_AHEAD = int(os.environ.get('GENRE_REFRESH_AHEAD', 60 * 10))
+
+genre_cache = RevalidatingCache(ttl=GENRE_CACHE_TTL,
+                                refresh_ahead=GENRE_REFRESH_AHEAD, name='genres')
+
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 60 * 10))
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 4096))
+
+search_cache = LRUCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL, name='search')
+search_flight = SingleFlight()
 
 
 def get_id(input_name, input_type):
     """Returns JSON object from Spotify with track/artist data"""
 
-    headers = {'Authorization': 'Bearer ' + session['token']}
+    headers = token_manager.headers()
     params = {
         'q': input_name,
         'type': input_type,
         'limit': 10
     }
-    resp = requests.get('https://api.spotify.com/v1/search',
-                        params=params, headers=headers).json()
+    resp = transport.get(f'{SPOTIFY_API_URL}/search',
+                         params=params, headers=headers).json()
     resp['input_type'] = input_type
     return resp
 
 
+def search(input_name, input_type):
+    """Returns the artist/track search results the search form needs. Results
+    are cached by normalized query, and identical searches that arrive while
+    one is already waiting on Spotify share its response"""
+
+    if input_type not in ('artist', 'track'):
+        raise KeyError(input_type)
+
+    query = ' '.join(input_name.split()).casefold()
+    key = (query, input_type)
+
+    results = search_cache.get(key)
+    if results is not None:
+        return results
+
+    def fetch():
+        results = project_search(get_id(query, input_type), input_type)
+        search_cache.set(key, results)
+        return results
+
+    return search_flight.do(key, fetch)
+
+
+def project_search(resp, input_type):
+    """Trims a Spotify search response down to the fields static/app.js reads"""
+
+    if input_type == 'artist':
+        items = [{'id': artist['id'], 'name': artist['name']}
+                 for artist in resp['artists']['items']]
+    else:
+        items = [{'id': track['id'],
+                  'name': track['name'],
+                  'artists': [{'name': track['artists'][0]['name']}]}
+                 for track in resp['tracks']['items']]
+
+    return {'input_type': input_type,
+            f'{input_type}s': {'total': resp[f'{input_type}s']['total'],
+                               'items': items}}
+
+
 def get_genres():
     """Returns a list of Spotify music genre tuples in format [('house','House')]"""
 
-    headers = {'Authorization': 'Bearer ' + session['token']}
-    raw = requests.get(
-        'https://api.spotify.com/v1/recommendations/available-genre-seeds', headers=headers).json()
+    # refreshes run on a background thread, which needs the app context for
+    # a token kept in the database
+    app = current_app._get_current_object()
+
+    def fetch(etag):
+        with app.app_context():
+            return fetch_genres(token_manager.headers(), etag)
+
+    return list(genre_cache.get(fetch))
+
+
+def fetch_genres(headers, etag=None):
+    """Requests the genre seed list from Spotify. Returns a tuple of the genre
+    choices and the response ETag, or (None, etag) if the list is unchanged"""
+
+    if etag:
+        headers = {**headers, 'If-None-Match': etag}
+    resp = transport.get(
+        f'{SPOTIFY_API_URL}/recommendations/available-genre-seeds', headers=headers)
+    if resp.status_code == 304:
+        return None, etag
+    raw = resp.json()
     genres = [(genre, genre.capitalize()) for genre in raw['genres']]
     genres[0] = ('', 'Genre (optional)')
-    return genres
+    return genres, resp.headers.get('ETag')
 
 
 def get_keys():